@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – allowance.py
+----------------------------------
+Daily spin allowance:
+ • The Europe/Rome calendar day, cached and recomputed only at local midnight
+ • One free spin per Rome day plus the purchased/credited extra_spins
+ • The same rule as a SQL expression, so allowances for many wallets
+   (e.g. a daily reminder push) come from a single query
+"""
+
+import time, datetime, threading
+from typing import Iterable, List, Optional, Tuple
+
+import pytz
+from sqlalchemy import case, func, or_
+
+from database import Session, User
+
+TIMEZONE = pytz.timezone("Europe/Rome")
+
+class RomeDay:
+    """Current Rome date; the timezone math runs once per day instead of once per request."""
+
+    def __init__(self, tz=TIMEZONE):
+        self.tz = tz
+        self._today: Optional[datetime.date] = None
+        self._next_midnight = 0.0
+        self._lock = threading.Lock()
+
+    def today(self) -> datetime.date:
+        if time.time() < self._next_midnight:
+            return self._today
+        with self._lock:
+            now = time.time()
+            if now >= self._next_midnight:
+                today = datetime.datetime.fromtimestamp(now, self.tz).date()
+                # Mezzanotte locale (localize gestisce l'ora legale)
+                midnight = self.tz.localize(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time.min))
+                self._today = today
+                self._next_midnight = midnight.timestamp()
+            return self._today
+
+rome_day = RomeDay()
+
+def today() -> datetime.date:
+    return rome_day.today()
+
+# ------------------ PYTHON RULE ------------------
+def free_spin_available(last_free_spin_date: Optional[datetime.date], day: Optional[datetime.date] = None) -> bool:
+    return last_free_spin_date is None or last_free_spin_date < (day or today())
+
+def available_spins(user, day: Optional[datetime.date] = None) -> int:
+    """Extra spins plus today's free spin, for a User row or a UserSnapshot."""
+    return (user.extra_spins or 0) + (1 if free_spin_available(user.last_free_spin_date, day) else 0)
+
+# ------------------ SQL RULE ------------------
+def free_spin_expr(day: Optional[datetime.date] = None):
+    day = day or today()
+    return case((or_(User.last_free_spin_date.is_(None), User.last_free_spin_date < day), 1), else_=0)
+
+def available_spins_expr(day: Optional[datetime.date] = None):
+    return func.coalesce(User.extra_spins, 0) + free_spin_expr(day)
+
+def allowances(wallets: Optional[Iterable[str]] = None, min_available: int = 1,
+               free_spin_only: bool = False, day: Optional[datetime.date] = None) -> List[Tuple[str, Optional[str], int]]:
+    """
+    (wallet, telegram_id, available spins) for every matching user, in one query.
+    `wallets` must be checksum addresses; free_spin_only keeps users whose free spin is still unused today.
+    """
+    day = day or today()
+    session = Session()
+    try:
+        query = session.query(User.wallet_address, User.telegram_id, available_spins_expr(day).label("available_spins"))
+        if wallets is not None:
+            query = query.filter(User.wallet_address.in_(list(wallets)))
+        if free_spin_only:
+            query = query.filter(free_spin_expr(day) == 1)
+        if min_available:
+            query = query.filter(available_spins_expr(day) >= min_available)
+        return [(wallet, telegram_id, int(spins)) for wallet, telegram_id, spins in query.order_by(User.id).all()]
+    finally:
+        session.close()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – analytics.py
+----------------------------------
+Prize analytics without scanning premi_vinti:
+ • Daily (UTC) rollups per prize and per winner, incremented in the same
+   transaction that records the prizes (spin, spin batch or history flush)
+ • Prize rows are striped like global_counter so concurrent spins do not
+   queue on one hot row; reads sum the stripes
+ • Streaming CSV/NDJSON export of the raw history with server-side cursors
+   (yield_per), in constant memory whatever the row count
+"""
+
+import os, io, csv, json, random, logging, datetime
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from database import Session, PremioVinto, PrizeRollup, WinnerRollup
+
+ROLLUP_STRIPES = int(os.getenv("ROLLUP_STRIPES", "4"))
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "2000"))
+EXPORT_COLUMNS = ("id", "timestamp", "user_id", "wallet", "telegram_id", "premio")
+
+def prize_value(premio: str) -> Tuple[float, int]:
+    """(GKY, NFT count) represented by a prize label such as "50 GKY" or "NFT Starter"."""
+    name = premio.strip().upper()
+    if name.endswith("GKY"):
+        try:
+            return float(name.split()[0]), 0
+        except ValueError:
+            return 0.0, 0
+    if "NFT" in name:
+        return 0.0, 1
+    return 0.0, 0
+
+def _is_win(premio: str) -> bool:
+    return premio.strip().upper() != "NO PRIZE"
+
+# ------------------ WRITE ------------------
+def _upsert(session, model, match: dict, increments: dict, initial: dict):
+    """Atomic `col = col + :x` update; inserts the row (in a savepoint) the first time."""
+    filters = [getattr(model, key) == value for key, value in match.items()]
+    values = {getattr(model, key): getattr(model, key) + amount for key, amount in increments.items()}
+    if session.query(model).filter(*filters).update(values, synchronize_session=False):
+        return
+    try:
+        with session.begin_nested():
+            session.add(model(**match, **initial))
+    except IntegrityError:
+        session.query(model).filter(*filters).update(values, synchronize_session=False)
+
+def record(session, rows: Iterable[dict]):
+    """
+    Adds prize history rows (dicts with user_id, wallet, premio, timestamp) to the rollups
+    inside the caller's transaction, one statement per (day, prize) and per (day, winner).
+    """
+    prizes: Dict[Tuple[datetime.date, str], List[float]] = defaultdict(lambda: [0, 0.0])
+    winners: Dict[Tuple[datetime.date, int], dict] = {}
+    for row in rows:
+        day = (row.get("timestamp") or datetime.datetime.utcnow()).date()
+        gky, nfts = prize_value(row["premio"])
+        entry = prizes[(day, row["premio"])]
+        entry[0] += 1
+        entry[1] += gky
+        if _is_win(row["premio"]):
+            winner = winners.setdefault((day, row["user_id"]), {"wallet": row["wallet"], "prizes": 0, "gky": 0.0, "nfts": 0})
+            winner["prizes"] += 1
+            winner["gky"] += gky
+            winner["nfts"] += nfts
+    stripe = random.randint(1, max(1, ROLLUP_STRIPES))
+    for (day, premio), (spins, gky) in prizes.items():
+        _upsert(session, PrizeRollup, {"day": day, "premio": premio, "stripe": stripe},
+                {"spins": spins, "gky": gky}, {"spins": spins, "gky": gky})
+    for (day, user_id), winner in winners.items():
+        counts = {"prizes": winner["prizes"], "gky": winner["gky"], "nfts": winner["nfts"]}
+        _upsert(session, WinnerRollup, {"day": day, "user_id": user_id}, counts, dict(counts, wallet=winner["wallet"]))
+
+def backfill(session):
+    """Rebuilds the rollups from premi_vinti with grouped queries (migration helper)."""
+    session.query(PrizeRollup).delete(synchronize_session=False)
+    session.query(WinnerRollup).delete(synchronize_session=False)
+    day = func.date(PremioVinto.timestamp)
+    prize_rows = 0
+    for bucket, premio, spins in session.query(day, PremioVinto.premio, func.count(PremioVinto.id)).group_by(day, PremioVinto.premio):
+        gky, _ = prize_value(premio)
+        session.add(PrizeRollup(day=_as_date(bucket), premio=premio, stripe=1, spins=spins, gky=gky * spins))
+        prize_rows += 1
+    winners: Dict[Tuple[datetime.date, int], WinnerRollup] = {}
+    grouped = (session.query(day, PremioVinto.user_id, func.max(PremioVinto.wallet), PremioVinto.premio, func.count(PremioVinto.id))
+               .group_by(day, PremioVinto.user_id, PremioVinto.premio))
+    for bucket, user_id, wallet, premio, count in grouped:
+        if not _is_win(premio):
+            continue
+        gky, nfts = prize_value(premio)
+        key = (_as_date(bucket), user_id)
+        winner = winners.get(key)
+        if winner is None:
+            winner = winners[key] = WinnerRollup(day=key[0], user_id=user_id, wallet=wallet, prizes=0, gky=0.0, nfts=0)
+            session.add(winner)
+        winner.prizes += count
+        winner.gky += gky * count
+        winner.nfts += nfts * count
+    logging.info(f"Prize rollups rebuilt: {prize_rows} prize buckets, {len(winners)} winner buckets")
+
+def _as_date(value) -> datetime.date:
+    # SQLite restituisce date() come stringa
+    return datetime.date.fromisoformat(value) if isinstance(value, str) else value
+
+# ------------------ READ ------------------
+def prizes_by_day(since: datetime.date, until: datetime.date) -> List[dict]:
+    session = Session()
+    try:
+        rows = (session.query(PrizeRollup.day, PrizeRollup.premio, func.sum(PrizeRollup.spins), func.sum(PrizeRollup.gky))
+                .filter(PrizeRollup.day >= since, PrizeRollup.day <= until)
+                .group_by(PrizeRollup.day, PrizeRollup.premio)
+                .order_by(PrizeRollup.day, PrizeRollup.premio).all())
+        return [{"day": day.isoformat(), "premio": premio, "spins": int(spins), "gky": float(gky or 0)}
+                for day, premio, spins, gky in rows]
+    finally:
+        session.close()
+
+def top_winners(since: datetime.date, until: datetime.date, limit: int = 10) -> List[dict]:
+    session = Session()
+    try:
+        gky = func.sum(WinnerRollup.gky).label("gky")
+        rows = (session.query(WinnerRollup.user_id, func.max(WinnerRollup.wallet), gky,
+                              func.sum(WinnerRollup.nfts), func.sum(WinnerRollup.prizes))
+                .filter(WinnerRollup.day >= since, WinnerRollup.day <= until)
+                .group_by(WinnerRollup.user_id)
+                .order_by(gky.desc()).limit(limit).all())
+        return [{"user_id": user_id, "wallet": wallet, "gky": float(total or 0), "nfts": int(nfts or 0), "prizes": int(prizes or 0)}
+                for user_id, wallet, total, nfts, prizes in rows]
+    finally:
+        session.close()
+
+# ------------------ EXPORT ------------------
+def iter_history(since: Optional[datetime.datetime] = None, until: Optional[datetime.datetime] = None,
+                 batch: int = EXPORT_BATCH) -> Iterator[tuple]:
+    """Streams premi_vinti rows in id order; the driver cursor is server-side where supported."""
+    session = Session()
+    try:
+        query = session.query(PremioVinto.id, PremioVinto.timestamp, PremioVinto.user_id, PremioVinto.wallet,
+                              PremioVinto.telegram_id, PremioVinto.premio)
+        if since is not None:
+            query = query.filter(PremioVinto.timestamp >= since)
+        if until is not None:
+            query = query.filter(PremioVinto.timestamp < until)
+        query = query.order_by(PremioVinto.id).execution_options(stream_results=True, yield_per=batch)
+        for row in query:
+            yield tuple(row)
+    finally:
+        session.close()
+
+def _cell(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+def export_csv(rows: Iterable[tuple], batch: int = EXPORT_BATCH) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow([_cell(value) for value in row])
+        count += 1
+        if count % batch == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_ndjson(rows: Iterable[tuple], batch: int = EXPORT_BATCH) -> Iterator[str]:
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(EXPORT_COLUMNS, (_cell(value) for value in row)))))
+        if len(chunk) >= batch:
+            yield "\n".join(chunk) + "\n"
+            chunk = []
+    if chunk:
+        yield "\n".join(chunk) + "\n"
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – assets.py
+-------------------------------
+Static asset pipeline for the mini app:
+ • Build step (at startup, or `python assets.py`): content hash per file,
+   fingerprinted names (sfondo.<hash>.png) and gzip/brotli variants of text files
+ • /static/... references inside HTML/CSS/JS are rewritten to the fingerprinted
+   URLs, which are served with immutable one-year caching
+ • Pages keep their plain names and are revalidated through strong ETags (304)
+ • Accept-Encoding negotiation; the file is handed to the server with the
+   ASGI pathsend extension when available (zero-copy), streamed otherwise
+"""
+
+import os, re, sys, gzip, hashlib, logging, mimetypes, threading
+from typing import Dict, List, Tuple
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, PlainTextResponse, Response
+
+try:
+    from starlette.routing import get_route_path
+except ImportError:  # Starlette < 0.33: Mount riscrive già scope["path"] relativo al prefisso
+    def get_route_path(scope) -> str:
+        return scope["path"]
+try:
+    import brotli
+except ImportError:  # opzionale: senza il pacchetto si servono solo gzip e identity
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.getenv("ASSET_BUILD_DIR", os.path.join(BASE_DIR, ".assets"))
+
+# Testo comprimibile; PNG e MP3 sono già compressi e vengono solo fingerprintati
+COMPRESSIBLE = {".html", ".js", ".css", ".json", ".svg", ".txt", ".map", ".xml"}
+REWRITABLE = {".html", ".js", ".css"}
+# Le pagine si aprono per URL (link, Telegram): niente fingerprint, solo revalidation
+PAGES = {".html"}
+MIN_COMPRESS_SIZE = 512
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+class Asset:
+    """One servable representation set: identity file plus optional encoded variants."""
+    __slots__ = ("path", "digest", "content_type", "variants", "immutable")
+
+    def __init__(self, path: str, digest: str, content_type: str, variants: Dict[str, str], immutable: bool):
+        self.path = path
+        self.digest = digest
+        self.content_type = content_type
+        self.variants = variants
+        self.immutable = immutable
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def _fingerprint(name: str, digest: str) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest[:10]}{ext}"
+
+def _write_once(path: str, data: bytes):
+    """Build outputs are content-addressed: an existing file is already correct."""
+    if os.path.exists(path):
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    # Atomico anche con più worker che compilano insieme
+    os.replace(tmp, path)
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match usa il confronto debole (RFC 9110): W/ non conta
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+class PathSendFileResponse(FileResponse):
+    """FileResponse that lets the server send the file itself when it supports `http.response.pathsend`."""
+
+    async def __call__(self, scope, receive, send):
+        if "http.response.pathsend" not in (scope.get("extensions") or {}) or scope.get("method") == "HEAD":
+            await super().__call__(scope, receive, send)
+            return
+        stat_result = self.stat_result or os.stat(self.path)
+        self.set_stat_headers(stat_result)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.pathsend", "path": self.path})
+
+class AssetStore:
+    """Builds the asset manifest for some mounted directories and serves it as an ASGI app per mount."""
+
+    def __init__(self, mounts: Dict[str, str], build_dir: str = BUILD_DIR):
+        # URL prefix -> directory, es. {"/static": ".../static"}
+        self.mounts = mounts
+        self.build_dir = build_dir
+        self.manifest: Dict[str, Dict[str, Asset]] = {prefix: {} for prefix in mounts}
+        self.fingerprints: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    # ------------------ BUILD ------------------
+    def _scan(self) -> List[Tuple[str, str, str]]:
+        files = []
+        for prefix, directory in self.mounts.items():
+            if not os.path.isdir(directory):
+                continue
+            for root, dirs, names in os.walk(directory):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                for name in names:
+                    if name.startswith(".") or name.endswith((".gz", ".br")):
+                        continue
+                    path = os.path.join(root, name)
+                    files.append((prefix, os.path.relpath(path, directory).replace(os.sep, "/"), path))
+        return files
+
+    def build(self) -> dict:
+        """(Re)builds fingerprints and compressed variants; returns a size summary."""
+        os.makedirs(self.build_dir, exist_ok=True)
+        files = self._scan()
+        contents: Dict[Tuple[str, str], bytes] = {}
+        fingerprints: Dict[str, str] = {}
+        # 1) fingerprint di tutto ciò che non è una pagina (dal contenuto originale)
+        for prefix, rel, path in files:
+            with open(path, "rb") as f:
+                data = f.read()
+            contents[(prefix, rel)] = data
+            if os.path.splitext(rel)[1].lower() not in PAGES:
+                fingerprints[f"{prefix}/{rel}"] = f"{prefix}/{_fingerprint(rel, _digest(data))}"
+        # 2) riscrittura dei riferimenti e varianti compresse
+        pattern = re.compile("|".join(re.escape(url) for url in sorted(fingerprints, key=len, reverse=True))) if fingerprints else None
+        manifest: Dict[str, Dict[str, Asset]] = {prefix: {} for prefix in self.mounts}
+        totals = {"files": 0, "bytes": 0, "gzip_bytes": 0, "br_bytes": 0}
+        for prefix, rel, path in files:
+            data = contents[(prefix, rel)]
+            ext = os.path.splitext(rel)[1].lower()
+            rewritten = False
+            if pattern is not None and ext in REWRITABLE:
+                text = data.decode("utf-8", errors="surrogateescape")
+                new_text, count = pattern.subn(lambda m: fingerprints[m.group(0)], text)
+                if count:
+                    data = new_text.encode("utf-8", errors="surrogateescape")
+                    rewritten = True
+            digest = _digest(data)
+            identity = path
+            if rewritten:
+                identity = os.path.join(self.build_dir, f"{digest}{ext}")
+                _write_once(identity, data)
+            variants = {}
+            if ext in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+                codecs = [("gzip", ".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+                if brotli is not None:
+                    codecs.append(("br", ".br", lambda raw: brotli.compress(raw, quality=11)))
+                for encoding, suffix, compress in codecs:
+                    target = os.path.join(self.build_dir, f"{digest}{ext}{suffix}")
+                    # Output già compilato da un avvio precedente: niente ricompressione (avvio più rapido)
+                    size = os.path.getsize(target) if os.path.exists(target) else None
+                    if size is None:
+                        encoded = compress(data)
+                        if len(encoded) >= len(data) * 0.95:
+                            continue
+                        _write_once(target, encoded)
+                        size = len(encoded)
+                    variants[encoding] = target
+                    totals[f"{encoding}_bytes"] += size
+            # Starlette aggiunge "; charset=utf-8" ai tipi text/*
+            content_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+            manifest[prefix][rel] = Asset(identity, digest, content_type, variants, immutable=False)
+            fingerprinted = fingerprints.get(f"{prefix}/{rel}")
+            if fingerprinted is not None:
+                # Un JS/CSS riscritto dipende da altri file: il suo fingerprint (dal sorgente) non basta per immutable
+                manifest[prefix][fingerprinted[len(prefix) + 1:]] = Asset(identity, digest, content_type, variants, immutable=not rewritten)
+            totals["files"] += 1
+            totals["bytes"] += len(data)
+        with self._lock:
+            self.manifest = manifest
+            self.fingerprints = fingerprints
+        logging.info(f"Assets built: {totals['files']} files, {totals['bytes']} bytes "
+                     f"(gzip text {totals['gzip_bytes']}, brotli text {totals['br_bytes'] if brotli else 'n/a'})")
+        return totals
+
+    def url(self, url: str) -> str:
+        """Fingerprinted URL for a plain /static/... URL (unchanged if unknown)."""
+        return self.fingerprints.get(url, url)
+
+    # ------------------ SERVE ------------------
+    def response(self, request: Request, prefix: str, rel: str) -> Response:
+        asset = self.manifest.get(prefix, {}).get(rel)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+        encoding = None
+        if asset.variants:
+            accepted = parse_accept_encoding(request.headers.get("accept-encoding", ""))
+            for candidate in ("br", "gzip"):
+                if candidate in asset.variants and accepted.get(candidate, accepted.get("*", 0.0)) > 0:
+                    encoding = candidate
+                    break
+        # ETag forte, diverso per ogni codifica (sono rappresentazioni diverse)
+        etag = f'"{asset.digest}-{encoding}"' if encoding else f'"{asset.digest}"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE if asset.immutable else REVALIDATE}
+        if asset.variants:
+            headers["Vary"] = "Accept-Encoding"
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        path = asset.variants[encoding] if encoding else asset.path
+        return PathSendFileResponse(path, headers=headers, media_type=asset.content_type)
+
+    def app(self, prefix: str):
+        """ASGI app for `app.mount(prefix, ...)`, in place of StaticFiles."""
+        async def serve(scope, receive, send):
+            if scope["type"] != "http":
+                return
+            request = Request(scope, receive)
+            if request.method not in ("GET", "HEAD"):
+                response = PlainTextResponse("Method Not Allowed", status_code=405)
+            else:
+                # Starlette recenti lasciano scope["path"] intero e spostano il prefisso in root_path
+                rel = get_route_path(scope).lstrip("/")
+                response = self.response(request, prefix, rel)
+            await response(scope, receive, send)
+        return serve
+
+def default_store() -> AssetStore:
+    return AssetStore({
+        "/static": os.path.join(BASE_DIR, "static"),
+        "/dist": os.path.join(BASE_DIR, "dist"),
+    })
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    store = default_store()
+    store.build()
+    if "-v" in sys.argv:
+        for source, target in sorted(store.fingerprints.items()):
+            print(f"{source} -> {target}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – benchmark.py
+----------------------------------
+Load test for the spin/buy/claim API:
+ • Drives /api/spin, /api/spins_status, /api/confirmbuy, /api/claim_task and
+   /api/balance against the ASGI app in-process (or a running server with --url)
+ • Polygon RPC is replaced by a local stub with configurable latency
+ • Reports throughput, latency percentiles, DB round-trips and allocations per
+   request, and writes machine-readable JSON to compare commits
+
+Examples:
+    python benchmark.py --requests 2000 --concurrency 50
+    python benchmark.py --endpoints spin,balance --rpc-latency-ms 80 --json bench.json
+"""
+
+import os, sys, json, time, asyncio, argparse, logging, secrets, subprocess, tempfile, tracemalloc
+from typing import Dict, List, Optional
+
+ENDPOINTS = ("spin", "spins_status", "confirmbuy", "claim_task", "balance")
+
+def _prepare_env(args):
+    # Da fare prima di importare main/database: DB isolato e nessun job di sfondo
+    if args.url is None and not os.getenv("DATABASE_URL"):
+        path = os.path.join(tempfile.mkdtemp(prefix="gianky-bench-"), "bench.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ.setdefault("DISTRIBUTION_PRIVATE_KEY", "0x" + "11" * 32)
+    os.environ.setdefault("TOKEN_ADDRESS", "0x370806781689E670f85311700445449aC7C3Ff7a")
+    os.environ["RUN_PAYOUT_WORKER"] = "0"
+    os.environ["RUN_CREDIT_SCHEDULER"] = "0"
+    os.environ.pop("NGROK_AUTH_TOKEN", None)
+    # Tutto il carico arriva da un solo IP: i rate limit misurerebbero solo i 429 (RATE_LIMITS=... per testarli)
+    os.environ.setdefault("RATE_LIMITS", "")
+
+# ------------------ STUB RPC ------------------
+class StubChain:
+    """Stands in for BlockchainClient: fixed answers after `latency` seconds."""
+
+    def __init__(self, latency: float, token_address: str, recipient: str):
+        self.latency = latency
+        self.token_address = token_address.lower()
+        self.recipient = recipient.lower()
+        self.calls = 0
+        # tx hash -> (sender, GKY) per i receipt di /api/confirmbuy
+        self.payments: Dict[str, tuple] = {}
+
+    async def _rpc(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def start(self):
+        return self
+
+    async def close(self):
+        pass
+
+    async def native_balance(self, address: str) -> int:
+        await self._rpc()
+        return 10 ** 18
+
+    async def token_balance(self, address: str) -> int:
+        await self._rpc()
+        return 500 * 10 ** 18
+
+    async def gas_price(self) -> int:
+        await self._rpc()
+        return 30 * 10 ** 9
+
+    async def rpc_batch(self, calls: list) -> list:
+        from confirmations import TRANSFER_TOPIC
+        await self._rpc()
+        receipts = []
+        for _, (tx_hash,) in calls:
+            sender, amount = self.payments.get(tx_hash.lower(), (None, 0))
+            if sender is None:
+                receipts.append(None)
+                continue
+            receipts.append({"status": "0x1", "logs": [{
+                "address": self.token_address,
+                "topics": [TRANSFER_TOPIC, "0x" + "0" * 24 + sender[2:].lower(), "0x" + "0" * 24 + self.recipient[2:]],
+                "data": hex(amount * 10 ** 18),
+            }]})
+        return receipts
+
+# ------------------ MEASUREMENT ------------------
+class DbCounter:
+    def __init__(self):
+        self.statements = 0
+
+    def install(self, engine):
+        from sqlalchemy import event
+        @event.listens_for(engine, "before_cursor_execute")
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            self.statements += 1
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+# ------------------ SCENARIOS ------------------
+def random_wallet() -> str:
+    return "0x" + secrets.token_hex(20)
+
+def build_request(endpoint: str, wallet: str, i: int, stub: Optional[StubChain]):
+    if endpoint == "spin":
+        return "POST", "/api/spin", {"wallet_address": wallet}
+    if endpoint == "spins_status":
+        return "GET", f"/api/spins_status/{wallet}", None
+    if endpoint == "balance":
+        return "GET", f"/api/balance/{wallet}", None
+    if endpoint == "claim_task":
+        return "POST", "/api/claim_task", {"wallet_address": wallet, "task_id": f"bench-{i}"}
+    if endpoint == "confirmbuy":
+        tx_hash = "0x" + secrets.token_hex(32)
+        if stub is not None:
+            stub.payments[tx_hash] = (wallet.lower(), 50)
+        return "POST", "/api/confirmbuy", {"wallet_address": wallet, "tx_hash": tx_hash, "num_spins": 1}
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+async def run_endpoint(client, endpoint: str, wallets: List[str], args, stub, db: Optional[DbCounter]) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(args.requests))
+    db_before = db.statements if db else 0
+    rpc_before = stub.calls if stub else 0
+    if args.allocations:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        alloc_before = tracemalloc.get_traced_memory()[0]
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, path, body = build_request(endpoint, wallets[i % len(wallets)], i, stub)
+            start = time.perf_counter()
+            # Chiave unica per richiesta: ogni spin è un giro vero, non un replay idempotente
+            headers = {"Idempotency-Key": f"bench-{endpoint}-{i}"} if method == "POST" else None
+            response = await client.request(method, path, json=body, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    result = {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3) if latencies else 0.0,
+        },
+    }
+    if db is not None:
+        result["db_statements_per_request"] = round((db.statements - db_before) / max(len(latencies), 1), 2)
+    if stub is not None:
+        result["rpc_calls_per_request"] = round((stub.calls - rpc_before) / max(len(latencies), 1), 3)
+    if args.allocations:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["alloc_peak_kib"] = round((peak - alloc_before) / 1024, 1)
+        result["alloc_retained_kib_per_request"] = round((current - alloc_before) / 1024 / max(len(latencies), 1), 3)
+    return result
+
+def grant_spins(wallets: List[str], spins: int):
+    """Gives every bench wallet enough extra spins for the spin scenario."""
+    from web3 import Web3
+    from database import Session, User
+    session = Session()
+    try:
+        for wallet in wallets:
+            session.add(User(wallet_address=Web3.to_checksum_address(wallet), extra_spins=spins, last_claimed_tasks=""))
+        session.commit()
+    finally:
+        session.close()
+
+async def main_async(args) -> dict:
+    import httpx
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    wallets = [random_wallet() for _ in range(args.wallets)]
+    stub = db = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+        lifespan = None
+    else:
+        import main
+        import database
+        stub = StubChain(args.rpc_latency_ms / 1000.0, main.TOKEN_ADDRESS, main.WALLET_DISTRIBUZIONE)
+        # Tutti i componenti che parlano con la chain usano lo stub (con le metriche RPC di /metrics)
+        from middleware import instrument_rpc
+        main.chain = instrument_rpc(stub)
+        main.confirmations.chain = stub
+        db = DbCounter()
+        db.install(database.engine)
+        lifespan = main.lifespan(main.app)
+        await lifespan.__aenter__()
+        grant_spins(wallets, args.requests)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=60)
+    results = []
+    try:
+        for endpoint in endpoints:
+            if endpoint not in ENDPOINTS:
+                raise SystemExit(f"Unknown endpoint {endpoint!r}; choose from {', '.join(ENDPOINTS)}")
+            results.append(await run_endpoint(client, endpoint, wallets, args, stub, db))
+    finally:
+        await client.aclose()
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "mode": "http" if args.url else "in-process",
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "wallets": args.wallets,
+            "rpc_latency_ms": args.rpc_latency_ms,
+        },
+        "results": results,
+    }
+
+def print_report(report: dict):
+    print(f"commit {report['commit']}  mode {report['mode']}  {report['config']}")
+    print(f"{'endpoint':<14} {'req/s':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7} {'db/req':>7} {'rpc/req':>8}")
+    for r in report["results"]:
+        lat = r["latency_ms"]
+        print(f"{r['endpoint']:<14} {r['throughput_rps']:>9} {lat['p50']:>9} {lat['p90']:>9} {lat['p99']:>9} {lat['max']:>9} "
+              f"{r['errors']:>7} {r.get('db_statements_per_request', '-'):>7} {r.get('rpc_calls_per_request', '-'):>8}")
+        if "alloc_peak_kib" in r:
+            print(f"{'':<14} alloc peak {r['alloc_peak_kib']} KiB, retained {r['alloc_retained_kib_per_request']} KiB/req")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Gianky API load test")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="comma-separated: " + ",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--wallets", type=int, default=100, help="distinct wallets to spread requests over")
+    parser.add_argument("--rpc-latency-ms", type=float, default=50.0, help="stub RPC latency (in-process mode)")
+    parser.add_argument("--allocations", action="store_true", help="measure allocations with tracemalloc (slower)")
+    parser.add_argument("--url", default=None, help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    _prepare_env(args)
+    # Una riga di log per richiesta falserebbe le misure
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = asyncio.run(main_async(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
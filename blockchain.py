@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – blockchain.py
+-----------------------------------
+Shared async Polygon RPC client:
+ • One AsyncWeb3 instance over a pooled keep-alive aiohttp session
+ • Token/NFT contract objects and ABIs built once at startup
+ • Never blocks the uvicorn event loop on RPC latency
+ • web3/eth_account/aiohttp (~1.5 s of imports) are loaded on first start,
+   in a worker thread, not when the module is imported
+"""
+
+import asyncio, logging
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from eth_utils import to_checksum_address
+
+if TYPE_CHECKING:
+    import aiohttp
+    from eth_account.signers.local import LocalAccount
+    from web3 import AsyncWeb3
+
+# ------------------ ABI ------------------
+ERC20_ABI = [
+    {
+        "constant": True,
+        "inputs": [{"name": "owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "payable": False,
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
+        "name": "transfer",
+        "outputs": [{"name": "", "type": "bool"}],
+        "payable": False,
+        "stateMutability": "nonpayable",
+        "type": "function"
+    },
+]
+
+ERC721_ABI = [
+    {
+        "constant": False,
+        "inputs": [
+            {"name": "from", "type": "address"},
+            {"name": "to", "type": "address"},
+            {"name": "tokenId", "type": "uint256"}
+        ],
+        "name": "safeTransferFrom",
+        "outputs": [],
+        "payable": False,
+        "stateMutability": "nonpayable",
+        "type": "function"
+    },
+]
+
+def _load_stack():
+    import aiohttp
+    from web3 import AsyncWeb3
+    from web3.providers.rpc import AsyncHTTPProvider
+    return aiohttp, AsyncWeb3, AsyncHTTPProvider
+
+# ------------------ CLIENT ------------------
+class BlockchainClient:
+    """Lazily started AsyncWeb3 client shared by every request."""
+
+    def __init__(self, provider_url: str, token_address: str, nft_address: Optional[str] = None,
+                 pool_size: int = 20, keepalive: float = 30.0, timeout: float = 15.0):
+        self.provider_url = provider_url
+        self.token_address = to_checksum_address(token_address)
+        self.nft_address = to_checksum_address(nft_address) if nft_address else None
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.w3: Optional["AsyncWeb3"] = None
+        self.token = None
+        self.nft = None
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._signers: Dict[str, "LocalAccount"] = {}
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> "BlockchainClient":
+        if self.w3 is not None:
+            return self
+        async with self._lock:
+            if self.w3 is not None:
+                return self
+            # Import pesanti fuori dall'event loop: le altre richieste continuano a essere servite
+            aiohttp, AsyncWeb3, AsyncHTTPProvider = await asyncio.to_thread(_load_stack)
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive)
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            provider = AsyncHTTPProvider(self.provider_url)
+            await provider.cache_async_session(self._session)
+            w3 = AsyncWeb3(provider)
+            self.token = w3.eth.contract(address=self.token_address, abi=ERC20_ABI)
+            if self.nft_address:
+                self.nft = w3.eth.contract(address=self.nft_address, abi=ERC721_ABI)
+            self.w3 = w3
+            logging.info(f"Blockchain client ready on {self.provider_url} (pool {self.pool_size})")
+        return self
+
+    async def close(self):
+        async with self._lock:
+            if self._session is not None:
+                await self._session.close()
+            self._session = None
+            self.w3 = None
+            self.token = None
+            self.nft = None
+
+    # ------------------ READ ------------------
+    async def native_balance(self, address: str) -> int:
+        await self.start()
+        return await self.w3.eth.get_balance(address)
+
+    async def token_balance(self, address: str) -> int:
+        await self.start()
+        return await self.token.functions.balanceOf(address).call()
+
+    async def gas_price(self) -> int:
+        await self.start()
+        return await self.w3.eth.gas_price
+
+    async def get_transaction(self, tx_hash: str):
+        await self.start()
+        return await self.w3.eth.get_transaction(tx_hash)
+
+    async def transaction_count(self, address: str, block: str = "pending") -> int:
+        await self.start()
+        return await self.w3.eth.get_transaction_count(address, block)
+
+    async def get_receipt(self, tx_hash: str):
+        """Returns the receipt, or None while the transaction is not mined."""
+        await self.start()
+        from web3.exceptions import TransactionNotFound
+        try:
+            return await self.w3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+
+    async def rpc(self, method: str, params: list) -> Any:
+        """Single raw JSON-RPC call over the pooled session; raises on RPC errors."""
+        await self.start()
+        payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+        async with self._session.post(self.provider_url, json=payload) as response:
+            response.raise_for_status()
+            reply = await response.json(content_type=None)
+        if "error" in reply:
+            raise RuntimeError(f"RPC {method} error: {reply['error']}")
+        return reply.get("result")
+
+    async def rpc_batch(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        """
+        Sends several JSON-RPC calls in one HTTP request over the pooled session.
+        Returns the raw results in call order (None for null results or per-call errors).
+        """
+        await self.start()
+        payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(calls)]
+        async with self._session.post(self.provider_url, json=payload) as response:
+            response.raise_for_status()
+            replies = await response.json(content_type=None)
+        if isinstance(replies, dict):
+            # Alcuni provider rispondono con un singolo errore all'intero batch
+            raise RuntimeError(f"RPC batch error: {replies.get('error')}")
+        results: List[Any] = [None] * len(calls)
+        for reply in replies:
+            if "error" in reply:
+                logging.warning(f"RPC batch call {reply.get('id')} failed: {reply['error']}")
+                continue
+            results[reply["id"]] = reply.get("result")
+        return results
+
+    # ------------------ WRITE ------------------
+    def signer(self, private_key: str) -> "LocalAccount":
+        """Local account for the key, derived once (eth_account is imported on first use)."""
+        account = self._signers.get(private_key)
+        if account is None:
+            from eth_account import Account
+            account = self._signers[private_key] = Account.from_key(private_key)
+        return account
+
+    def sign(self, tx: dict, private_key: str) -> Tuple[str, bytes]:
+        """Signs locally (no RPC); returns (tx hash hex, raw transaction)."""
+        signed_tx = self.signer(private_key).sign_transaction(tx)
+        raw_tx = signed_tx.raw_transaction if hasattr(signed_tx, 'raw_transaction') else signed_tx.rawTransaction
+        tx_hash = signed_tx.hash.hex()
+        return (tx_hash if tx_hash.startswith("0x") else "0x" + tx_hash), raw_tx
+
+    async def send_raw(self, raw_tx: bytes) -> str:
+        await self.start()
+        tx_hash = await self.w3.eth.send_raw_transaction(raw_tx)
+        return tx_hash.hex()
+
+    async def sign_and_send(self, tx: dict, private_key: str) -> str:
+        """Signs locally and broadcasts; returns the tx hash as hex."""
+        _, raw_tx = self.sign(tx, private_key)
+        return await self.send_raw(raw_tx)
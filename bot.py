@@ -1,17 +1,50 @@
 #!/usr/bin/env python3
-import logging
+"""
+Gianky Coin Web App – bot.py
+----------------------------
+Telegram bot (/start deep-links to the mini app, /giankyadmin report):
+ • Polling (Procfile `worker`, default) or webhook mode (BOT_MODE=webhook):
+   standalone receiver from `python bot.py`, or mounted on the FastAPI app
+   when BOT_WEBHOOK_URL is set for the web dyno (then scale `worker` to 0:
+   Telegram refuses polling while a webhook is registered); webhook mode
+   refuses to start without BOT_WEBHOOK_SECRET
+ • Updates are handled concurrently, at most BOT_CONCURRENCY at a time
+ • The admin report is built in a worker thread and cached for BOT_REPORT_TTL
+   seconds, so the bot loop never waits on the database
+ • Optional daily reminder (BOT_REMINDER_TIME=HH:MM, Europe/Rome) to users whose
+   free spin is still unused: one allowance query, sent by the standalone bot
+   process only (web workers would each send it again)
+"""
+
+import os, asyncio, logging, secrets, datetime
+from typing import List, Optional, Tuple
+
 from telegram import Update, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes
 from telegram.request import HTTPXRequest
 
-from database import Session, GlobalCounter, init_db
-
-init_db()
+import analytics
+from allowance import TIMEZONE, allowances
+from cache import TTLCache
+from counters import counters
 
 # Token e URL della mini app
-TOKEN = "8097932093:AAHpO7TnynwowBQHAoDVpG9e0oxGm7z9gFE"
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "8097932093:AAHpO7TnynwowBQHAoDVpG9e0oxGm7z9gFE")
 BASE_WEB_APP_URL = "https://gianky-bot-test-f275065c7d33.herokuapp.com/static/index.html"
 
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "32"))
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "10"))
+BOT_READ_TIMEOUT = float(os.getenv("BOT_READ_TIMEOUT", "10"))
+BOT_REPORT_TTL = float(os.getenv("BOT_REPORT_TTL", "30"))
+# Webhook: URL pubblico dell'app (es. https://<app>.herokuapp.com), path e secret verificato su ogni update
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL")
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/webhook")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET")
+# Promemoria giornaliero del free spin: ora locale di Roma "HH:MM", vuoto = disattivato
+BOT_REMINDER_TIME = os.getenv("BOT_REMINDER_TIME", "")
+BOT_REMINDER_RATE = float(os.getenv("BOT_REMINDER_RATE", "25"))  # messaggi/s, sotto il limite di Telegram
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
@@ -29,7 +62,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.info(f"Referral rilevato: {referral_code}")
     else:
         logging.info("Nessun referral rilevato nel comando /start")
-    
+
     final_url = BASE_WEB_APP_URL + referral_param if referral_param else BASE_WEB_APP_URL
 
     keyboard = [
@@ -38,34 +71,144 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Clicca qui per aprire la mini app:", reply_markup=reply_markup)
 
+# ------------------ ADMIN REPORT ------------------
+report_cache = TTLCache("admin_report", maxsize=1, ttl=BOT_REPORT_TTL)
+
+def build_report() -> str:
+    """Reads totals and today's prizes (blocking DB work: run it in a thread)."""
+    totals = counters.totals()
+    if totals is None:
+        return "Nessun dato disponibile."
+    total_in = totals["total_in"]
+    total_out = totals["total_out"]
+    balance = total_in - total_out
+    report_text = (
+        f"📊 **Report GiankyCoin** 📊\n\n"
+        f"**Entrate Totali:** {total_in} GKY\n"
+        f"**Uscite Totali:** {total_out} GKY\n"
+        f"**Bilancio:** {balance} GKY"
+    )
+    today = datetime.datetime.utcnow().date()
+    prizes = analytics.prizes_by_day(today, today)
+    if prizes:
+        report_text += "\n\n**Premi oggi (UTC):**\n" + "\n".join(f"{p['premio']}: {p['spins']}" for p in prizes)
+    return report_text
+
 async def giankyadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    session = Session()
     try:
-        counter = session.query(GlobalCounter).first()
-        if counter is None:
-            report_text = "Nessun dato disponibile."
-        else:
-            total_in = counter.total_in
-            total_out = counter.total_out
-            balance = total_in - total_out
-            report_text = (
-                f"📊 **Report GiankyCoin** 📊\n\n"
-                f"**Entrate Totali:** {total_in} GKY\n"
-                f"**Uscite Totali:** {total_out} GKY\n"
-                f"**Bilancio:** {balance} GKY"
-            )
+        report_text = await report_cache.get_or_load("report", lambda: asyncio.to_thread(build_report))
         await update.message.reply_text(report_text, parse_mode="Markdown")
     except Exception as e:
         logging.error(f"Errore in giankyadmin: {e}")
         await update.message.reply_text("Errore nel recupero dei dati.")
-    finally:
-        session.close()
 
-def main():
-    request = HTTPXRequest(connect_timeout=30, read_timeout=30)
-    app = ApplicationBuilder().token(TOKEN).request(request).build()
+# ------------------ DAILY REMINDER ------------------
+def reminder_recipients() -> List[Tuple[str, int]]:
+    """(telegram chat id, available spins) of users with today's free spin unused: a single query."""
+    return [(telegram_id, spins) for _, telegram_id, spins in allowances(free_spin_only=True)
+            if telegram_id and telegram_id != "N/A"]
+
+def seconds_until(hh_mm: str, now: Optional[datetime.datetime] = None) -> float:
+    """Seconds until the next HH:MM in Europe/Rome."""
+    hour, minute = (int(part) for part in hh_mm.split(":"))
+    now = now or datetime.datetime.now(TIMEZONE)
+    target = TIMEZONE.localize(datetime.datetime.combine(now.date(), datetime.time(hour, minute)))
+    if target <= now:
+        target = TIMEZONE.localize(datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time(hour, minute)))
+    return (target - now).total_seconds()
+
+async def send_daily_reminders(bot) -> int:
+    recipients = await asyncio.to_thread(reminder_recipients)
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Apri Mini App", web_app=WebAppInfo(url=BASE_WEB_APP_URL))]])
+    sent = 0
+    for chat_id, spins in recipients:
+        try:
+            await bot.send_message(chat_id=chat_id, reply_markup=reply_markup,
+                                   text=f"🎡 Il tuo giro gratuito di oggi ti aspetta! Giri disponibili: {spins}")
+            sent += 1
+        except Exception as e:
+            logging.warning(f"Reminder to {chat_id} failed: {e}")
+        await asyncio.sleep(1 / BOT_REMINDER_RATE)
+    logging.info(f"Daily reminders sent: {sent}/{len(recipients)}")
+    return sent
+
+async def _reminder_loop(app: Application):
+    while True:
+        await asyncio.sleep(seconds_until(BOT_REMINDER_TIME))
+        try:
+            await send_daily_reminders(app.bot)
+        except Exception as e:
+            logging.error(f"Daily reminder error: {e}")
+
+async def _start_reminders(app: Application):
+    app.bot_data["reminder_task"] = asyncio.get_running_loop().create_task(_reminder_loop(app))
+    logging.info(f"Daily reminder scheduled at {BOT_REMINDER_TIME} (Europe/Rome)")
+
+# ------------------ APPLICATION ------------------
+def build_application(with_updater: bool = True, reminders: bool = False) -> Application:
+    request = HTTPXRequest(connect_timeout=BOT_CONNECT_TIMEOUT, read_timeout=BOT_READ_TIMEOUT)
+    builder = ApplicationBuilder().token(TOKEN).request(request).concurrent_updates(BOT_CONCURRENCY)
+    if not with_updater:
+        # Montato su FastAPI: gli update arrivano dall'endpoint, non da un Updater
+        builder = builder.updater(None)
+    if reminders and BOT_REMINDER_TIME:
+        builder = builder.post_init(_start_reminders)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("giankyadmin", giankyadmin))
+    return app
+
+# ------------------ WEBHOOK ON THE WEB APP ------------------
+_mounted: Optional[Application] = None
+
+def _require_webhook_secret():
+    # Senza secret chiunque conosca l'URL può iniettare update (es. /giankyadmin con un id falso).
+    # Niente secret generato al volo: con più worker uvicorn ognuno ne registrerebbe uno diverso
+    if not BOT_WEBHOOK_SECRET:
+        raise RuntimeError("Error: webhook mode requires BOT_WEBHOOK_SECRET (e.g. python -c \"import secrets; print(secrets.token_urlsafe(32))\").")
+
+async def start_webhook():
+    """Starts the bot inside the web process and registers the webhook with Telegram."""
+    global _mounted
+    if _mounted is not None:
+        return
+    _require_webhook_secret()
+    app = build_application(with_updater=False)
+    await app.initialize()
+    await app.start()
+    await app.bot.set_webhook(BOT_WEBHOOK_URL.rstrip("/") + BOT_WEBHOOK_PATH, secret_token=BOT_WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES)
+    _mounted = app
+    logging.info(f"Bot webhook active on {BOT_WEBHOOK_PATH} (concurrency {BOT_CONCURRENCY})")
+
+async def stop_webhook():
+    global _mounted
+    if _mounted is None:
+        return
+    app, _mounted = _mounted, None
+    await app.stop()
+    await app.shutdown()
+
+async def handle_webhook(data: dict, secret: Optional[str]) -> bool:
+    """Queues one update; False if the secret does not match or the bot is not running."""
+    if _mounted is None or not BOT_WEBHOOK_SECRET or not secrets.compare_digest(secret or "", BOT_WEBHOOK_SECRET):
+        return False
+    # La risposta a Telegram parte subito: l'update è elaborato dalla coda dell'Application
+    await _mounted.update_queue.put(Update.de_json(data, _mounted.bot))
+    return True
+
+def main():
+    from database import init_db
+    init_db()
+    app = build_application(reminders=True)
+    if BOT_MODE == "webhook":
+        if not BOT_WEBHOOK_URL:
+            raise RuntimeError("Error: BOT_MODE=webhook requires BOT_WEBHOOK_URL.")
+        _require_webhook_secret()
+        logging.info("Bot in esecuzione (webhook)...")
+        app.run_webhook(listen="0.0.0.0", port=int(os.getenv("PORT", "8443")), url_path=BOT_WEBHOOK_PATH.lstrip("/"),
+                        webhook_url=BOT_WEBHOOK_URL.rstrip("/") + BOT_WEBHOOK_PATH, secret_token=BOT_WEBHOOK_SECRET)
+        return
     logging.info("Bot in esecuzione...")
     app.run_polling()
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – cache.py
+------------------------------
+Bounded in-process async cache:
+ • Per-key TTL with LRU eviction once maxsize is reached
+ • Single-flight: concurrent misses on the same key share one upstream call
+ • Optional shared second level (shared_state backend) for multi-worker deployments
+ • Hit/miss/coalesced counters for monitoring
+"""
+
+import time, json, asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+class TTLCache:
+    """LRU + TTL cache whose loader runs at most once per key at a time."""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 10.0, shared=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Secondo livello condiviso tra processi (valori JSON), None = solo locale
+        self.shared = shared
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+        # Un load in corso non verrà salvato: il suo risultato può essere già vecchio
+        self._inflight.pop(key, None)
+        if self.shared is not None:
+            try:
+                asyncio.get_running_loop().create_task(self.shared.delete(self._shared_key(key)))
+            except RuntimeError:
+                pass
+
+    def _shared_key(self, key: Hashable) -> str:
+        return f"cache:{self.name}:{key}"
+
+    async def _load_through(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        if self.shared is None:
+            return await loader()
+        raw = await self.shared.get(self._shared_key(key))
+        if raw is not None:
+            self.shared_hits += 1
+            return json.loads(raw)
+        value = await loader()
+        if value is not None:
+            await self.shared.set(self._shared_key(key), json.dumps(value), self.ttl)
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        sentinel = _MISSING
+        value = self.get(key, sentinel)
+        if value is not sentinel:
+            self.hits += 1
+            return value
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load_through(key, loader)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Evita "Future exception was never retrieved" se nessuno era in attesa
+            future.exception()
+            raise
+        else:
+            if self._inflight.get(key) is future:
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "shared_hits": self.shared_hits,
+        }
+
+_MISSING = object()
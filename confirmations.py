@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – confirmations.py
+--------------------------------------
+Purchase confirmation from ERC-20 Transfer logs:
+ • Fetches the receipt once and decodes Transfer(from, to, value) on the GKY token
+ • Checks sender, WALLET_DISTRIBUZIONE recipient and amount
+ • Mined (confirmed or reverted) receipts are cached by hash
+ • Concurrent lookups are coalesced into one JSON-RPC batch request
+"""
+
+import asyncio
+from typing import List, Optional, Tuple
+
+from cache import TTLCache
+
+# keccak256("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+def _topic_address(topic: str) -> str:
+    return "0x" + topic[-40:].lower()
+
+def decode_transfers(receipt: dict, token_address: str) -> List[Tuple[str, str, int]]:
+    """Returns (from, to, value) for every Transfer log emitted by token_address (addresses lower-case)."""
+    token = token_address.lower()
+    transfers = []
+    for log in receipt.get("logs") or []:
+        topics = log.get("topics") or []
+        if (log.get("address") or "").lower() != token or len(topics) != 3 or topics[0].lower() != TRANSFER_TOPIC:
+            continue
+        data = log.get("data") or "0x"
+        transfers.append((_topic_address(topics[1]), _topic_address(topics[2]), int(data, 16) if data != "0x" else 0))
+    return transfers
+
+class ConfirmationEngine:
+    """Verifies GKY payments to the distribution wallet from transaction receipts."""
+
+    def __init__(self, chain, token_address: str, recipient: str, decimals: int = 18,
+                 cache_size: int = 10000, batch_window: float = 0.01, max_batch: int = 50):
+        self.chain = chain
+        self.token_address = token_address.lower()
+        self.recipient = recipient.lower()
+        self.unit = 10 ** decimals
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        # Un receipt minato non cambia più: TTL lungo, solo per limitare la memoria
+        self.receipts = TTLCache("receipts", maxsize=cache_size, ttl=24 * 3600)
+        self._queue: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+
+    # ------------------ BATCHING ------------------
+    def _fetch_receipt(self, tx_hash: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((tx_hash, future))
+        if len(self._queue) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._queue = self._queue, []
+        if batch:
+            asyncio.create_task(self._execute(batch))
+
+    async def _execute(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            self.batches += 1
+            results = await self.chain.rpc_batch([("eth_getTransactionReceipt", [tx_hash]) for tx_hash, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), receipt in zip(batch, results):
+            if not future.done():
+                future.set_result(receipt)
+
+    # ------------------ DECODE ------------------
+    async def _load(self, tx_hash: str) -> Optional[dict]:
+        receipt = await self._fetch_receipt(tx_hash)
+        if receipt is None:
+            return None
+        return {
+            "status": int(receipt.get("status") or "0x0", 16),
+            "transfers": decode_transfers(receipt, self.token_address),
+        }
+
+    async def summary(self, tx_hash: str) -> Optional[dict]:
+        """Decoded receipt ({"status", "transfers"}), or None while the tx is not mined."""
+        tx_hash = tx_hash.strip().lower()
+        result = await self.receipts.get_or_load(tx_hash, lambda: self._load(tx_hash))
+        if result is None:
+            # Non ancora minato: non va tenuto in cache
+            self.receipts.invalidate(tx_hash)
+        return result
+
+    async def verify(self, tx_hash: str, sender: str, cost: int) -> Tuple[bool, str]:
+        """True if tx_hash moved at least `cost` GKY from `sender` to the distribution wallet."""
+        result = await self.summary(tx_hash)
+        if result is None:
+            return False, "TX not mined yet."
+        if result["status"] != 1:
+            return False, "TX reverted."
+        sender = sender.lower()
+        paid = sum(value for src, dst, value in result["transfers"] if src == sender and dst == self.recipient)
+        if paid == 0:
+            return False, "No GKY transfer from this wallet to the distribution wallet."
+        if paid < cost * self.unit:
+            return False, f"Insufficient amount: {paid / self.unit} GKY < {cost} GKY."
+        return True, "OK"
+
+    def stats(self) -> dict:
+        return dict(self.receipts.stats(), batches=self.batches)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – counters.py
+---------------------------------
+GKY in/out totals without a hot single row:
+ • Increments are atomic SQL updates (`total_in = total_in + :x`), no read-modify-write
+ • Writes are spread over COUNTER_STRIPES rows of global_counter, summed on read
+ • Optional in-process accumulation flushed every COUNTER_FLUSH_MS
+
+The legacy single row (id=1) simply becomes stripe 1.
+"""
+
+import os, random, logging, threading
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from database import Session, GlobalCounter
+
+class GlobalCounters:
+    """Striped, atomically incremented GlobalCounter totals."""
+
+    def __init__(self, stripes: int = 8, flush_ms: int = 0):
+        self.stripes = max(1, stripes)
+        self.flush_interval = flush_ms / 1000.0
+        self._pending_in = 0.0
+        self._pending_out = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    # ------------------ WRITE ------------------
+    def add(self, total_in: float = 0.0, total_out: float = 0.0, session=None):
+        """
+        Adds to the totals. With `session` the update joins the caller's transaction;
+        otherwise it is buffered (if accumulation is on) or committed on its own.
+        """
+        if not total_in and not total_out:
+            return
+        if session is not None:
+            self._apply(session, total_in, total_out)
+            return
+        if self._thread is not None:
+            with self._lock:
+                self._pending_in += total_in
+                self._pending_out += total_out
+            return
+        self._write(total_in, total_out)
+
+    def _increment(self, session, stripe: int, total_in: float, total_out: float) -> int:
+        return (session.query(GlobalCounter).filter(GlobalCounter.id == stripe)
+                .update({GlobalCounter.total_in: GlobalCounter.total_in + total_in,
+                         GlobalCounter.total_out: GlobalCounter.total_out + total_out},
+                        synchronize_session=False))
+
+    def _apply(self, session, total_in: float, total_out: float):
+        stripe = random.randint(1, self.stripes)
+        if self._increment(session, stripe, total_in, total_out):
+            return
+        # Prima scrittura su questa stripe: crea la riga (in un savepoint per la race)
+        try:
+            with session.begin_nested():
+                session.add(GlobalCounter(id=stripe, total_in=total_in, total_out=total_out))
+        except IntegrityError:
+            self._increment(session, stripe, total_in, total_out)
+
+    def _write(self, total_in: float, total_out: float) -> bool:
+        session = Session()
+        try:
+            self._apply(session, total_in, total_out)
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error updating global counters: {e}")
+            return False
+        finally:
+            session.close()
+
+    # ------------------ ACCUMULATION ------------------
+    def start(self):
+        """Enables in-process accumulation if COUNTER_FLUSH_MS > 0."""
+        if self.flush_interval > 0 and self._thread is None:
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="counter-flusher", daemon=True)
+            self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            total_in, total_out = self._pending_in, self._pending_out
+            self._pending_in = self._pending_out = 0.0
+        if (total_in or total_out) and not self._write(total_in, total_out):
+            with self._lock:
+                self._pending_in += total_in
+                self._pending_out += total_out
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    # ------------------ READ ------------------
+    def totals(self) -> Optional[dict]:
+        """Sums every stripe (plus unflushed local deltas); None if nothing was ever recorded."""
+        session = Session()
+        try:
+            count, total_in, total_out = session.query(
+                func.count(GlobalCounter.id), func.sum(GlobalCounter.total_in), func.sum(GlobalCounter.total_out)
+            ).one()
+        finally:
+            session.close()
+        with self._lock:
+            pending_in, pending_out = self._pending_in, self._pending_out
+        if not count and not pending_in and not pending_out:
+            return None
+        return {"total_in": (total_in or 0.0) + pending_in, "total_out": (total_out or 0.0) + pending_out}
+
+counters = GlobalCounters(
+    stripes=int(os.getenv("COUNTER_STRIPES", "8")),
+    flush_ms=int(os.getenv("COUNTER_FLUSH_MS", "0")),
+)
@@ -1,15 +1,54 @@
 import os
+import logging
 import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Date
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows: nessun lock, basta un processo in sviluppo
+    fcntl = None
+from sqlalchemy import (create_engine, Column, Integer, BigInteger, Boolean, String, Float, DateTime, Date,
+                        ForeignKey, Index, UniqueConstraint, event, func)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+# Heroku fornisce ancora lo schema "postgres://", non più accettato da SQLAlchemy
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+def _engine_options() -> dict:
+    if IS_SQLITE:
+        return {"connect_args": {"check_same_thread": False, "timeout": float(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")) / 1000}}
+    # Pool per processo: con N worker uvicorn le connessioni totali sono N * (size + overflow)
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+
+engine = create_engine(DATABASE_URL, **_engine_options())
+
+if IS_SQLITE:
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL: lettori e scrittore non si bloccano a vicenda tra processi diversi
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))}")
+        cursor.execute(f"PRAGMA synchronous={os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}")
+        cursor.close()
+        # pysqlite non emette BEGIN prima di un SAVEPOINT: se begin_nested() è la prima scrittura,
+        # RELEASE SAVEPOINT fa commit da solo e la riga sfugge al rollback della transazione esterna.
+        # Workaround documentato da SQLAlchemy: transazioni gestite da noi (BEGIN esplicito sotto)
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _sqlite_begin(conn):
+        conn.exec_driver_sql("BEGIN")
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
 Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -20,10 +59,10 @@ class User(Base):
     telegram_id = Column(String, nullable=True)
     wallet_address = Column(String, unique=True, index=True, nullable=False)
     extra_spins = Column(Integer, default=0)         # giri extra acquistati/non ancora usati
-    referred_by = Column(String, nullable=True)      # indirizzo wallet di chi lo ha referenziato (se applicabile)
+    referred_by = Column(String, nullable=True, index=True)  # indirizzo wallet di chi lo ha referenziato (se applicabile)
     last_play_date = Column(DateTime, nullable=True)   # usato per altri scopi se necessario
     last_free_spin_date = Column(Date, nullable=True)  # data in cui è stato usato il free spin giornaliero
-    last_claimed_tasks = Column(String, nullable=True) # task già reclamati (separati da virgola)
+    last_claimed_tasks = Column(String, nullable=True) # legacy: sostituito dalla tabella task_claims
     nonce = Column(String, nullable=True)              # nonce temporaneo per login (una volta)
 
 class PremioVinto(Base):
@@ -34,6 +73,10 @@ class PremioVinto(Base):
     premio = Column(String, nullable=False)
     user_id = Column(Integer, nullable=False)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        Index("ix_premi_vinti_timestamp", "timestamp"),
+        Index("ix_premi_vinti_user_timestamp", "user_id", "timestamp"),
+    )
 
 class GlobalCounter(Base):
     __tablename__ = "global_counter"
@@ -41,5 +84,229 @@ class GlobalCounter(Base):
     total_in = Column(Float, default=0.0)   # totale GKY ricevuti (acquisti)
     total_out = Column(Float, default=0.0)  # totale GKY inviati (premi)
 
+# Coda persistente dei pagamenti (token/NFT) inviati dal wallet di distribuzione
+class Payout(Base):
+    __tablename__ = "payouts"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)                 # "token" oppure "nft"
+    wallet = Column(String, nullable=False)               # destinatario (checksum)
+    amount = Column(Integer, nullable=True)               # GKY (solo per kind="token")
+    token_id = Column(Integer, nullable=True)             # tokenId (solo per kind="nft")
+    status = Column(String, nullable=False, default="pending", index=True)  # pending/sent/confirmed/failed
+    nonce = Column(Integer, nullable=True)
+    gas_price = Column(BigInteger, nullable=True)         # wei dell'ultimo invio
+    tx_hash = Column(String, nullable=True, index=True)   # hash dell'ultimo invio
+    previous_hashes = Column(String, nullable=True)       # hash sostituiti (replace-by-fee), separati da virgola
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+# Task reclamati: un record per (utente, task), duplicati rifiutati dal DB
+class TaskClaim(Base):
+    __tablename__ = "task_claims"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    task_id = Column(String, nullable=False, index=True)
+    claimed_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (UniqueConstraint("user_id", "task_id", name="uq_task_claims_user_task"),)
+
+# Referral: ogni utente può essere referenziato una sola volta
+class Referral(Base):
+    __tablename__ = "referrals"
+    id = Column(Integer, primary_key=True, index=True)
+    referee_id = Column(Integer, ForeignKey("users.id"), nullable=False, unique=True)
+    referrer_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+    referrer_wallet = Column(String, nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Accrediti differiti (es. giri dei task): persistiti, applicati dal CreditScheduler alla scadenza
+class ScheduledCredit(Base):
+    __tablename__ = "scheduled_credits"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    extra_spins = Column(Integer, nullable=False)
+    reason = Column(String, nullable=True)
+    due_at = Column(DateTime, nullable=False)
+    applied_at = Column(DateTime, nullable=True)          # NULL finché non è stato accreditato
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index("ix_scheduled_credits_pending", "applied_at", "due_at"),)
+
+# Transazioni on-chain già usate per un acquisto (una sola volta, anche tra più processi)
+class ConsumedTransaction(Base):
+    __tablename__ = "consumed_transactions"
+    id = Column(Integer, primary_key=True, index=True)
+    tx_hash = Column(String, nullable=False, unique=True, index=True)  # minuscolo, con 0x
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    purpose = Column(String, nullable=False, default="buy_spins")
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Pagamenti GKY in ingresso trovati dall'indexer (un record per tx)
+class IncomingPayment(Base):
+    __tablename__ = "incoming_payments"
+    id = Column(Integer, primary_key=True, index=True)
+    tx_hash = Column(String, nullable=False, unique=True, index=True)  # minuscolo, con 0x
+    block_number = Column(Integer, nullable=False, index=True)
+    sender = Column(String, nullable=False, index=True)                # minuscolo
+    amount = Column(Float, nullable=False)                             # GKY
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    extra_spins = Column(Integer, nullable=False, default=0)           # giri accreditati (0 = importo non valido o già confermato a mano)
+    credited = Column(Boolean, nullable=False, default=False)          # True se accreditato dall'indexer
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# Rollup giornalieri (giorno UTC) dello storico premi, aggiornati insieme a premi_vinti
+class PrizeRollup(Base):
+    __tablename__ = "prize_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False)
+    premio = Column(String, nullable=False)
+    stripe = Column(Integer, nullable=False, default=1)    # righe per (giorno, premio) sommate in lettura
+    spins = Column(Integer, nullable=False, default=0)
+    gky = Column(Float, nullable=False, default=0.0)
+    __table_args__ = (UniqueConstraint("day", "premio", "stripe", name="uq_prize_rollups_day_premio_stripe"),)
+
+class WinnerRollup(Base):
+    __tablename__ = "winner_rollups"
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False, index=True)
+    user_id = Column(Integer, nullable=False)
+    wallet = Column(String, nullable=False)
+    prizes = Column(Integer, nullable=False, default=0)    # premi vinti (NO PRIZE escluso)
+    gky = Column(Float, nullable=False, default=0.0)
+    nfts = Column(Integer, nullable=False, default=0)
+    __table_args__ = (UniqueConstraint("day", "user_id", name="uq_winner_rollups_day_user"),)
+
+# Punto di ripresa dei processi che seguono la chain (es. indexer pagamenti)
+class ChainCheckpoint(Base):
+    __tablename__ = "chain_checkpoints"
+    name = Column(String, primary_key=True)
+    block_number = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+# Lease a tempo: un solo processo alla volta esegue i job singleton (es. payout worker)
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+# Migrazioni già applicate (una riga per nome)
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# ------------------ MIGRATIONS ------------------
+def _create_missing_indexes(session):
+    """create_all() does not add indexes to tables that already exist."""
+    connection = session.connection()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+def _backfill_claims_and_referrals(session):
+    """One-shot copy of users.last_claimed_tasks / users.referred_by into the new tables."""
+    claims = 0
+    existing = set(session.query(TaskClaim.user_id, TaskClaim.task_id).all())
+    for user_id, tasks in session.query(User.id, User.last_claimed_tasks).filter(User.last_claimed_tasks.isnot(None), User.last_claimed_tasks != ""):
+        for task_id in dict.fromkeys(t.strip() for t in tasks.split(",")):
+            if task_id and (user_id, task_id) not in existing:
+                session.add(TaskClaim(user_id=user_id, task_id=task_id))
+                existing.add((user_id, task_id))
+                claims += 1
+    referrals = 0
+    referred = set(r for (r,) in session.query(Referral.referee_id).all())
+    for user_id, referred_by in session.query(User.id, User.referred_by).filter(User.referred_by.isnot(None), User.referred_by != ""):
+        if user_id in referred:
+            continue
+        referrer = session.query(User.id, User.wallet_address).filter(func.lower(User.wallet_address) == referred_by.strip().lower()).first()
+        session.add(Referral(referee_id=user_id, referrer_id=referrer[0] if referrer else None,
+                             referrer_wallet=referrer[1] if referrer else referred_by.strip()))
+        referrals += 1
+    logging.info(f"Backfill: {claims} task claims, {referrals} referrals")
+
+def _checksum_wallets(session):
+    """Rewrites legacy non-checksum users.wallet_address so lookups can use the unique index."""
+    from web3 import Web3
+    fixed = 0
+    existing = set(w for (w,) in session.query(User.wallet_address).all())
+    for user_id, wallet in session.query(User.id, User.wallet_address).all():
+        try:
+            normalized = Web3.to_checksum_address(wallet.strip())
+        except ValueError:
+            continue
+        if normalized == wallet:
+            continue
+        if normalized in existing:
+            logging.warning(f"Wallet {wallet} (user {user_id}) duplicates {normalized}: left unchanged")
+            continue
+        session.query(User).filter(User.id == user_id).update({User.wallet_address: normalized}, synchronize_session=False)
+        existing.add(normalized)
+        fixed += 1
+    logging.info(f"Checksummed {fixed} wallet addresses")
+
+def _backfill_prize_rollups(session):
+    """Builds prize_rollups / winner_rollups from the existing premi_vinti history."""
+    from analytics import backfill
+    backfill(session)
+
+MIGRATIONS = [
+    ("0001_indexes", _create_missing_indexes),
+    ("0002_backfill_claims_referrals", _backfill_claims_and_referrals),
+    ("0003_checksum_wallets", _checksum_wallets),
+    ("0004_prize_history_indexes", _create_missing_indexes),
+    ("0005_backfill_prize_rollups", _backfill_prize_rollups),
+]
+
+def run_migrations():
+    session = Session()
+    try:
+        applied = set(name for (name,) in session.query(SchemaMigration.name).all())
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+            migration(session)
+            session.add(SchemaMigration(name=name))
+            session.commit()
+            logging.info(f"Migration applied: {name}")
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# Chiave pg_advisory_lock condivisa da tutti i processi (web worker, bot, indexer)
+INIT_LOCK_KEY = 727101
+
+@contextmanager
+def _init_lock():
+    """Serializes schema creation and migrations across processes starting together."""
+    if IS_SQLITE:
+        path = engine.url.database
+        if fcntl is None or not path or path == ":memory:":
+            yield
+            return
+        # Stesso host per forza con SQLite: basta un flock accanto al file del DB
+        with open(f"{path}-init.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(f"SELECT pg_advisory_lock({INIT_LOCK_KEY})")
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql(f"SELECT pg_advisory_unlock({INIT_LOCK_KEY})")
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # Con --workers=N ogni worker arriva qui insieme: uno crea e migra, gli altri aspettano
+    # e poi trovano tutto già applicato
+    with _init_lock():
+        Base.metadata.create_all(bind=engine)
+        run_migrations()
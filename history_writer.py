@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – history_writer.py
+---------------------------------------
+Opt-in write-behind buffer for PremioVinto rows:
+ • Records are collected in memory and bulk-inserted every N records or T ms
+ • Flushing always happens on the writer thread, never on the request path
+ • Backpressure before the spin: admit() waits up to HISTORY_ADMIT_TIMEOUT_MS
+   for room under HISTORY_MAX_BUFFER and refuses the spin if there is none, so
+   no spins are consumed for a prize the history could not hold
+ • Rows of admitted spins are never discarded: a failed batch goes back to the
+   head of the buffer and is retried
+ • close() flushes what is left on shutdown
+
+HISTORY_WRITE_MODE=sync (default) keeps one insert per spin inside the spin
+transaction; HISTORY_WRITE_MODE=buffered trades up to one batch of history
+on a crash for far fewer commits/fsyncs.
+"""
+
+import os, datetime, logging, threading
+from typing import List, Optional
+
+import analytics
+from database import Session, PremioVinto
+
+class HistoryWriter:
+    """Thread-backed batch writer for prize history."""
+
+    def __init__(self, batch_size: int = 200, flush_ms: int = 250, max_buffer: int = 5000, admit_ms: int = 1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        self.max_buffer = max_buffer
+        self.admit_timeout = admit_ms / 1000.0
+        self._buffer: List[dict] = []
+        self._lock = threading.Lock()
+        # Notificata dopo ogni flush riuscito: sveglia chi aspetta spazio in admit()
+        self._room = threading.Condition(self._lock)
+        # Serializza i flush: l'ordine di inserimento resta quello di arrivo
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def start(self):
+        if self._thread is None:
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def record(self, telegram_id: Optional[str], wallet: str, premio: str, user_id: int):
+        row = {
+            "telegram_id": telegram_id or "N/A",
+            "wallet": wallet,
+            "premio": premio,
+            "user_id": user_id,
+            "timestamp": datetime.datetime.utcnow(),
+        }
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("History writer is closed.")
+            # Lo spin è già committato: la riga si tiene sempre, il limite lo fa rispettare admit()
+            self._buffer.append(row)
+            size = len(self._buffer)
+        if size >= self.batch_size:
+            self._wakeup.set()
+
+    def has_room(self, count: int = 1) -> bool:
+        with self._lock:
+            return len(self._buffer) + count <= self.max_buffer
+
+    def admit(self, count: int = 1) -> bool:
+        """
+        Call before a spin consumes anything: waits up to admit_timeout for room for
+        `count` rows. False means the writer is saturated and the spin must be refused.
+        """
+        with self._room:
+            if len(self._buffer) + count > self.max_buffer:
+                self._wakeup.set()
+                if not self._room.wait_for(lambda: len(self._buffer) + count <= self.max_buffer, self.admit_timeout):
+                    self.rejected += 1
+                    return False
+            return True
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            session = Session()
+            try:
+                session.bulk_insert_mappings(PremioVinto, rows)
+                analytics.record(session, rows)
+                session.commit()
+                self.flushed += len(rows)
+                self.flushes += 1
+                with self._room:
+                    self._room.notify_all()
+                return len(rows)
+            except Exception as e:
+                session.rollback()
+                self.errors += 1
+                logging.error(f"History flush error ({len(rows)} rows kept for retry): {e}")
+                with self._lock:
+                    # Le righe più vecchie restano in testa, nell'ordine di arrivo
+                    self._buffer[:0] = rows
+                return 0
+            finally:
+                session.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        return {"pending": self.pending(), "flushed": self.flushed, "flushes": self.flushes, "errors": self.errors,
+                "rejected": self.rejected}
+
+def from_env() -> Optional[HistoryWriter]:
+    """Returns a writer when HISTORY_WRITE_MODE=buffered, None for the default synchronous mode."""
+    if os.getenv("HISTORY_WRITE_MODE", "sync").lower() != "buffered":
+        return None
+    return HistoryWriter(
+        batch_size=int(os.getenv("HISTORY_FLUSH_SIZE", "200")),
+        flush_ms=int(os.getenv("HISTORY_FLUSH_MS", "250")),
+        max_buffer=int(os.getenv("HISTORY_MAX_BUFFER", "5000")),
+        admit_ms=int(os.getenv("HISTORY_ADMIT_TIMEOUT_MS", "1000")),
+    )
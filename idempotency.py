@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – idempotency.py
+------------------------------------
+Idempotent execution of state-changing endpoints (spin, spin_batch, confirmbuy, claim_referral):
+ • Client key (Idempotency-Key header), scoped by route and wallet and kept for
+   IDEMPOTENCY_TTL seconds; with SHARED_STATE_URL a retry on another worker
+   gets the same answer
+ • Without a header, routes whose body is a natural key (confirmbuy: tx_hash,
+   claim_referral: referee + referrer) derive the key from route + body and keep
+   it for IDEMPOTENCY_WINDOW seconds, enough to absorb webview double-taps.
+   Two identical spin bodies are two legitimate spins: without a header they
+   are never deduplicated
+ • A concurrent duplicate waits for the first execution and shares its result
+   (or its error) instead of running the handler again
+ • Only successful results are remembered: a failed request can be retried
+"""
+
+import os, json, hashlib
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from cache import TTLCache
+
+MAX_KEY_LENGTH = 255
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request."""
+
+def fingerprint(route: str, payload: dict) -> str:
+    body = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{route}\n{body}".encode()).hexdigest()
+
+class Idempotency:
+    """Result cache + in-flight map (TTLCache single-flight) keyed by idempotency key."""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600.0, window: float = 2.0, shared=None):
+        self.keys = TTLCache("idempotency", maxsize=maxsize, ttl=ttl, shared=shared)
+        self.derived = TTLCache("idempotency_derived", maxsize=maxsize, ttl=window)
+        self.executed = 0
+        self.replayed = 0
+
+    async def run(self, route: str, scope: str, key: Optional[str], payload: dict,
+                  handler: Callable[[], Awaitable[Any]], derive: bool = False) -> Tuple[Any, bool]:
+        """
+        Runs handler() at most once per key; returns (result, replayed).
+        `scope` (the wallet) keeps one client's keys from matching another's.
+        Without `key`, `derive` dedups on the body; otherwise handler() just runs.
+        """
+        if not key and not derive:
+            self.executed += 1
+            return await handler(), False
+        digest = fingerprint(route, payload)
+        if key:
+            if len(key) > MAX_KEY_LENGTH:
+                raise IdempotencyConflict(f"Idempotency-Key longer than {MAX_KEY_LENGTH} characters.")
+            cache, cache_key = self.keys, f"{route}:{scope.lower()}:{key}"
+        else:
+            cache, cache_key = self.derived, f"{route}:{digest}"
+        executed = False
+
+        async def execute():
+            nonlocal executed
+            executed = True
+            self.executed += 1
+            # Il fingerprint viaggia con il risultato: un riuso della chiave con un altro body viene rifiutato
+            return {"fingerprint": digest, "result": await handler()}
+
+        entry = await cache.get_or_load(cache_key, execute)
+        if entry["fingerprint"] != digest:
+            raise IdempotencyConflict("Idempotency-Key already used for a different request.")
+        if not executed:
+            self.replayed += 1
+        return entry["result"], not executed
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "replayed": self.replayed,
+                "keys": self.keys.stats(), "derived": self.derived.stats()}
+
+def from_env(shared=None) -> Idempotency:
+    return Idempotency(
+        maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("IDEMPOTENCY_TTL", "600")),
+        window=float(os.getenv("IDEMPOTENCY_WINDOW", "2")),
+        shared=shared,
+    )
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – identity.py
+---------------------------------
+Wallet → user resolution:
+ • Memoized EIP-55 checksum (keccak once per distinct address string)
+ • Bounded LRU of address → user snapshot (id, spins state, claimed tasks)
+ • Lookups by the unique wallet_address index, always in checksum form
+ • Snapshots are dropped on every local write and expire after a short TTL,
+   so writes from other processes (indexer, other workers) show up quickly
+"""
+
+import os, time, logging, datetime, threading, functools
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from eth_utils import to_checksum_address
+from sqlalchemy.exc import IntegrityError
+
+import allowance
+from database import Session, User, TaskClaim
+
+@functools.lru_cache(maxsize=int(os.getenv("CHECKSUM_CACHE_SIZE", "65536")))
+def checksum(address: str) -> str:
+    """EIP-55 checksum (what Web3.to_checksum_address calls), memoized; ValueError on a malformed address."""
+    return to_checksum_address(address)
+
+class UserSnapshot:
+    """Read-only copy of the user columns the API answers from."""
+    __slots__ = ("id", "wallet_address", "telegram_id", "extra_spins", "last_free_spin_date", "claimed_tasks", "loaded_at")
+
+    def __init__(self, id: int, wallet_address: str, telegram_id: Optional[str], extra_spins: int,
+                 last_free_spin_date: Optional[datetime.date], claimed_tasks: Optional[Tuple[str, ...]] = None):
+        self.id = id
+        self.wallet_address = wallet_address
+        self.telegram_id = telegram_id
+        self.extra_spins = extra_spins or 0
+        self.last_free_spin_date = last_free_spin_date
+        # None = non ancora caricati (solo /api/claimed_tasks li usa)
+        self.claimed_tasks = claimed_tasks
+        self.loaded_at = time.monotonic()
+
+    def available_spins(self, today: Optional[datetime.date] = None) -> int:
+        return allowance.available_spins(self, today)
+
+class IdentityCache:
+    """LRU of checksum address → UserSnapshot, with user id → address for invalidation."""
+
+    def __init__(self, maxsize: int = 50000, ttl: float = 5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, UserSnapshot]" = OrderedDict()
+        self._by_id: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, wallet: str) -> Optional[UserSnapshot]:
+        with self._lock:
+            snapshot = self._entries.get(wallet)
+            if snapshot is None:
+                return None
+            if time.monotonic() - snapshot.loaded_at > self.ttl:
+                self._drop(wallet)
+                return None
+            self._entries.move_to_end(wallet)
+            return snapshot
+
+    def _put(self, snapshot: UserSnapshot):
+        with self._lock:
+            self._entries[snapshot.wallet_address] = snapshot
+            self._entries.move_to_end(snapshot.wallet_address)
+            self._by_id[snapshot.id] = snapshot.wallet_address
+            while len(self._entries) > self.maxsize:
+                wallet, old = self._entries.popitem(last=False)
+                self._by_id.pop(old.id, None)
+
+    def _drop(self, wallet: str):
+        snapshot = self._entries.pop(wallet, None)
+        if snapshot is not None:
+            self._by_id.pop(snapshot.id, None)
+
+    def resolve(self, wallet_address: str, create: bool = True) -> Optional[UserSnapshot]:
+        """Snapshot for the wallet (get-or-create unless create=False); ValueError on a bad address."""
+        wallet = checksum(wallet_address)
+        snapshot = self._get(wallet)
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+        self.misses += 1
+        session = Session()
+        try:
+            row = (session.query(User.id, User.telegram_id, User.extra_spins, User.last_free_spin_date)
+                   .filter(User.wallet_address == wallet).first())
+            if row is None:
+                if not create:
+                    return None
+                user = User(wallet_address=wallet, extra_spins=0, last_free_spin_date=None, last_claimed_tasks="")
+                session.add(user)
+                try:
+                    session.commit()
+                    row = (user.id, None, 0, None)
+                    logging.info(f"New user created: {wallet}")
+                except IntegrityError:
+                    # Creato nel frattempo da una richiesta concorrente
+                    session.rollback()
+                    row = (session.query(User.id, User.telegram_id, User.extra_spins, User.last_free_spin_date)
+                           .filter(User.wallet_address == wallet).one())
+            snapshot = UserSnapshot(row[0], wallet, row[1], row[2], row[3])
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self._put(snapshot)
+        return snapshot
+
+    def claimed_tasks(self, wallet_address: str) -> Tuple[str, ...]:
+        snapshot = self.resolve(wallet_address)
+        if snapshot.claimed_tasks is None:
+            session = Session()
+            try:
+                rows = session.query(TaskClaim.task_id).filter(TaskClaim.user_id == snapshot.id).order_by(TaskClaim.id).all()
+            finally:
+                session.close()
+            # Gli snapshot sono immutabili per chi li legge: se ne mette in cache uno nuovo
+            loaded = UserSnapshot(snapshot.id, snapshot.wallet_address, snapshot.telegram_id, snapshot.extra_spins,
+                                  snapshot.last_free_spin_date, tuple(task_id for (task_id,) in rows))
+            # Lo stato dei giri resta quello letto prima: non ne allunga la validità
+            loaded.loaded_at = snapshot.loaded_at
+            self._put(loaded)
+            snapshot = loaded
+        return snapshot.claimed_tasks
+
+    def invalidate(self, *wallet_addresses: str):
+        with self._lock:
+            for wallet_address in wallet_addresses:
+                self._drop(checksum(wallet_address))
+
+    def invalidate_ids(self, *user_ids: int):
+        with self._lock:
+            for user_id in user_ids:
+                wallet = self._by_id.get(user_id)
+                if wallet is not None:
+                    self._drop(wallet)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_id.clear()
+
+    def stats(self) -> dict:
+        info = checksum.cache_info()
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "checksum_hits": info.hits, "checksum_misses": info.misses}
+
+identities = IdentityCache(
+    maxsize=int(os.getenv("IDENTITY_CACHE_SIZE", "50000")),
+    ttl=float(os.getenv("IDENTITY_CACHE_TTL", "5")),
+)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – indexer.py
+--------------------------------
+Incoming-payment indexer (Procfile `indexer` process):
+ • Follows GKY Transfer logs to WALLET_DISTRIBUZIONE with paged eth_getLogs
+ • Only reads blocks INDEXER_CONFIRMATIONS deep, so reorgs never reach the DB
+ • Credits extra_spins (1/3/10 for 50/125/300 GKY) and saves the block
+   checkpoint in one transaction per page
+ • /api/confirmbuy then answers from incoming_payments without any RPC
+"""
+
+import os, asyncio, logging
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from blockchain import BlockchainClient
+from confirmations import TRANSFER_TOPIC
+from counters import counters
+from database import Session, User, IncomingPayment, ChainCheckpoint, init_db
+from identity import checksum
+from ledger import TxAlreadyUsed, ledger, normalize_tx_hash
+
+CHECKPOINT_NAME = "incoming_payments"
+
+# Pacchetti di giri extra: (giri, costo in GKY), dal più grande
+SPIN_PACKAGES = ((10, 300), (3, 125), (1, 50))
+
+def spins_for_amount(amount: float) -> int:
+    """Largest package paid for by `amount` GKY (0 if below the cheapest)."""
+    for spins, cost in SPIN_PACKAGES:
+        if amount >= cost:
+            return spins
+    return 0
+
+def find_payment(tx_hash: str) -> Optional[IncomingPayment]:
+    session = Session()
+    try:
+        return session.query(IncomingPayment).filter(IncomingPayment.tx_hash == normalize_tx_hash(tx_hash)).first()
+    finally:
+        session.close()
+
+class PaymentIndexer:
+    """Polls Transfer logs to the distribution wallet and credits purchases."""
+
+    def __init__(self, chain: BlockchainClient, token_address: str, recipient: str,
+                 confirmations: int = 30, page_size: int = 2000, poll_interval: float = 5.0,
+                 start_block: Optional[int] = None, decimals: int = 18):
+        self.chain = chain
+        self.token_address = token_address.lower()
+        self.recipient_topic = "0x" + "0" * 24 + recipient.lower()[2:]
+        self.confirmations = confirmations
+        self.page_size = page_size
+        self.poll_interval = poll_interval
+        self.start_block = start_block
+        self.unit = 10 ** decimals
+
+    def _checkpoint(self) -> Optional[int]:
+        session = Session()
+        try:
+            row = session.get(ChainCheckpoint, CHECKPOINT_NAME)
+            return row.block_number if row else None
+        finally:
+            session.close()
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Indexer error: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def sync_once(self) -> int:
+        """Indexes every confirmed block after the checkpoint; returns the number of payments seen."""
+        head = int(await self.chain.rpc("eth_blockNumber", []), 16)
+        safe = head - self.confirmations
+        last = self._checkpoint()
+        if last is None:
+            # Primo avvio: non scansiona dalla genesi
+            last = (self.start_block - 1) if self.start_block is not None else safe
+            self._save_page([], last)
+            logging.info(f"Indexer starting after block {last}")
+        seen = 0
+        while last < safe:
+            to_block = min(last + self.page_size, safe)
+            logs = await self.chain.rpc("eth_getLogs", [{
+                "address": self.token_address,
+                "fromBlock": hex(last + 1),
+                "toBlock": hex(to_block),
+                "topics": [TRANSFER_TOPIC, None, self.recipient_topic],
+            }])
+            seen += self._save_page(logs or [], to_block)
+            last = to_block
+        return seen
+
+    def _save_page(self, logs: list, to_block: int) -> int:
+        """Stores and credits one page of logs together with the new checkpoint (one commit)."""
+        # Raggruppa per tx: più Transfer nella stessa tx si sommano
+        payments: "OrderedDict[str, dict]" = OrderedDict()
+        for log in logs:
+            if log.get("removed"):
+                continue
+            tx_hash = normalize_tx_hash(log["transactionHash"])
+            sender = "0x" + log["topics"][1][-40:].lower()
+            value = int(log.get("data") or "0x0", 16)
+            entry = payments.setdefault(tx_hash, {"sender": sender, "value": 0, "block": int(log["blockNumber"], 16)})
+            if entry["sender"] == sender:
+                entry["value"] += value
+        session = Session()
+        try:
+            known = set(h for (h,) in session.query(IncomingPayment.tx_hash)
+                        .filter(IncomingPayment.tx_hash.in_(list(payments))).all()) if payments else set()
+            credits = 0
+            for tx_hash, entry in payments.items():
+                if tx_hash in known:
+                    continue
+                amount = entry["value"] / self.unit
+                spins = spins_for_amount(amount)
+                user_id = self._user_id(session, entry["sender"]) if spins else None
+                credited = False
+                if spins:
+                    try:
+                        ledger.consume(session, tx_hash, user_id=user_id, purpose="indexer")
+                        session.query(User).filter(User.id == user_id).update(
+                            {User.extra_spins: User.extra_spins + spins}, synchronize_session=False)
+                        counters.add(total_in=amount, session=session)
+                        credited = True
+                        credits += 1
+                    except TxAlreadyUsed:
+                        # Già confermato via /api/confirmbuy
+                        pass
+                session.add(IncomingPayment(
+                    tx_hash=tx_hash, block_number=entry["block"], sender=entry["sender"], amount=amount,
+                    user_id=user_id, extra_spins=spins if credited else 0, credited=credited,
+                ))
+            checkpoint = session.get(ChainCheckpoint, CHECKPOINT_NAME)
+            if checkpoint is None:
+                session.add(ChainCheckpoint(name=CHECKPOINT_NAME, block_number=to_block))
+            else:
+                checkpoint.block_number = to_block
+            session.commit()
+            if credits:
+                logging.info(f"Indexer credited {credits} purchases up to block {to_block}")
+            return len(payments)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _user_id(self, session, sender: str) -> int:
+        wallet = checksum(sender)
+        row = session.query(User.id).filter(User.wallet_address == wallet).first()
+        if row:
+            return row[0]
+        user = User(wallet_address=wallet, extra_spins=0, last_free_spin_date=None, last_claimed_tasks="")
+        session.add(user)
+        session.flush()
+        return user.id
+
+def main():
+    load_dotenv()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    init_db()
+    token_address = os.getenv("TOKEN_ADDRESS")
+    if not token_address:
+        raise RuntimeError("Error: TOKEN_ADDRESS not set.")
+    chain = BlockchainClient(os.getenv("PROVIDER_URL", "https://polygon-rpc.com/"), token_address)
+    start_block = os.getenv("INDEXER_START_BLOCK")
+    indexer = PaymentIndexer(
+        chain, token_address,
+        os.getenv("WALLET_DISTRIBUZIONE", "0xBc0c054066966a7A6C875981a18376e2296e5815"),
+        confirmations=int(os.getenv("INDEXER_CONFIRMATIONS", "30")),
+        page_size=int(os.getenv("INDEXER_PAGE_SIZE", "2000")),
+        poll_interval=float(os.getenv("INDEXER_POLL_INTERVAL", "5")),
+        start_block=int(start_block) if start_block else None,
+    )
+    logging.info("Indexer in esecuzione...")
+    asyncio.run(indexer.run())
+
+if __name__ == "__main__":
+    main()
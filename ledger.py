@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – ledger.py
+-------------------------------
+Persistent used-transaction ledger:
+ • consumed_transactions has a unique index on tx_hash: insert-or-reject is atomic
+ • A bounded in-memory LRU of known-consumed hashes short-circuits replays
+ • Correct across restarts and between uvicorn workers (the database decides)
+"""
+
+import os, threading
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError
+
+from database import Session, ConsumedTransaction
+
+class TxAlreadyUsed(Exception):
+    """Raised when a tx hash has already been consumed."""
+
+def normalize_tx_hash(tx_hash: str) -> str:
+    tx_hash = tx_hash.strip().lower()
+    return tx_hash if tx_hash.startswith("0x") else "0x" + tx_hash
+
+class TxLedger:
+    """Insert-or-reject ledger of consumed tx hashes with an LRU front."""
+
+    def __init__(self, front_size: int = 50000):
+        self.front_size = front_size
+        # Solo hash già consumati: un consumo è definitivo, quindi la cache non scade mai
+        self._front: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, tx_hash: str):
+        with self._lock:
+            self._front[tx_hash] = None
+            self._front.move_to_end(tx_hash)
+            while len(self._front) > self.front_size:
+                self._front.popitem(last=False)
+
+    def is_consumed(self, tx_hash: str) -> bool:
+        tx_hash = normalize_tx_hash(tx_hash)
+        with self._lock:
+            if tx_hash in self._front:
+                return True
+        session = Session()
+        try:
+            found = session.query(ConsumedTransaction.id).filter(ConsumedTransaction.tx_hash == tx_hash).first() is not None
+        finally:
+            session.close()
+        if found:
+            self._remember(tx_hash)
+        return found
+
+    def consume(self, session, tx_hash: str, user_id: int = None, purpose: str = "buy_spins"):
+        """
+        Records tx_hash in the caller's transaction (savepoint). Raises TxAlreadyUsed if
+        it is already there; the caller's commit makes the consumption final.
+        """
+        tx_hash = normalize_tx_hash(tx_hash)
+        try:
+            with session.begin_nested():
+                session.add(ConsumedTransaction(tx_hash=tx_hash, user_id=user_id, purpose=purpose))
+        except IntegrityError:
+            self._remember(tx_hash)
+            raise TxAlreadyUsed(tx_hash)
+
+    def committed(self, tx_hash: str):
+        """Call after the consuming transaction commits, so later replays skip the database."""
+        self._remember(normalize_tx_hash(tx_hash))
+
+ledger = TxLedger(front_size=int(os.getenv("TX_LEDGER_CACHE_SIZE", "50000")))
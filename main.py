@@ -9,33 +9,115 @@ Manages:
  • Endpoints for claiming referral and tasks (with delayed credit)
 """
 
-import os, random, datetime, pytz, logging, asyncio
+import os, random, datetime, logging, asyncio
+from contextlib import asynccontextmanager
 from typing import Optional
-from pyngrok import ngrok
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-import uvicorn
-
-from web3 import Web3
-from eth_account.messages import encode_defunct
-from jose import JWTError, jwt
-
-from database import Session, User, PremioVinto, GlobalCounter, init_db
+from sqlalchemy.exc import IntegrityError
+
+# web3, eth_account, jose, pyngrok e uvicorn si importano al primo uso (blockchain.py, create_access_token, start_tunnel):
+# l'import di main resta leggero e l'avvio del dyno non paga ~1.5 s di librerie
+from eth_utils import from_wei as _from_wei, to_wei as _to_wei
+
+import allowance
+import analytics
+from assets import default_store
+from blockchain import BlockchainClient
+from cache import TTLCache
+from confirmations import ConfirmationEngine
+from counters import counters
+from database import Session, User, TaskClaim, Referral, engine, init_db
+from payouts import PayoutWorker, enqueue_payout, queue_depth
+from prize_engine import engine as prize_engine
+from identity import checksum, identities
+from idempotency import IdempotencyConflict, from_env as idempotency_from_env
+from indexer import find_payment
+from middleware import (MetricsMiddleware, RateLimitMiddleware, instrument_engine, instrument_rpc, metrics,
+                        profiler_from_env, rate_limiter_from_env)
+from ledger import TxAlreadyUsed, ledger
+from scheduler import CreditScheduler
+from shared_state import DatabaseLease, shared
+from spin_service import NoSpinsLeft, perform_spin, perform_spin_batch
+import history_writer
 from dotenv import load_dotenv
 load_dotenv()
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
-init_db()
-
-app = FastAPI(title="Gianky Coin Web App API")
 
-# Ottieni il percorso assoluto della directory static
-static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-
-# Monta la directory static su /static
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+# ------------------ LIFESPAN ------------------
+# Nessun effetto collaterale all'import: schema, tunnel e worker partono qui, una volta per processo
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    await asyncio.to_thread(static_assets.build)
+    start_tunnel()
+    # Il client RPC (import di web3 in un thread) si avvia in background: il server è pronto subito
+    # e la prima richiesta che usa la chain attende solo il tempo che manca
+    chain_warmup = asyncio.create_task(chain.start())
+    chain_warmup.add_done_callback(_log_warmup_error)
+    if RUN_PAYOUT_WORKER:
+        payout_worker.start()
+    if prize_history is not None:
+        prize_history.start()
+    counters.start()
+    if RUN_CREDIT_SCHEDULER:
+        credit_scheduler.start()
+    if telegram_bot is not None:
+        await telegram_bot.start_webhook()
+    try:
+        yield
+    finally:
+        if telegram_bot is not None:
+            await telegram_bot.stop_webhook()
+        await payout_worker.stop()
+        await credit_scheduler.stop()
+        await chain.close()
+        if prize_history is not None:
+            prize_history.close()
+        counters.close()
+        await shared.close()
+
+def _log_warmup_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Blockchain client warm-up failed: {task.exception()}")
+
+app = FastAPI(title="Gianky Coin Web App API", lifespan=lifespan)
+
+# ------------------ METRICS ------------------
+# Latenza per route con tempo DB/RPC; profilo cProfile delle richieste lente solo se abilitato
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+profiler = profiler_from_env()
+
+# ------------------ RATE LIMITS ------------------
+# "route scope giri/s burst": le route che chiamano l'RPC a pagamento o scrivono sul DB hanno budget propri,
+# più un tetto per IP su tutte le API (RATE_LIMITS="" li disattiva)
+DEFAULT_RATE_LIMITS = (
+    "/api/* ip 20 60;"
+    "/api/balance/{wallet_address} wallet 1 5;"
+    "/api/balance/{wallet_address} ip 3 15;"
+    "/api/grant_test_spins ip 0.1 3;"
+    "/api/grant_test_spins wallet 0.1 3;"
+    "/api/spin wallet 2 5;"
+    "/api/spin_batch wallet 1 3;"
+    "/api/confirmbuy wallet 0.5 5;"
+    "/api/claim_referral ip 0.2 5;"
+    "/api/claim_task wallet 1 10"
+)
+rate_limiter = rate_limiter_from_env(DEFAULT_RATE_LIMITS, shared=shared)
+if rate_limiter is not None:
+    # Aggiunto prima: gira dentro MetricsMiddleware, così anche i 429 sono misurati
+    app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+app.add_middleware(MetricsMiddleware, profiler=profiler)
+instrument_engine(engine)
+metrics.describe("gianky_spins_total", "counter", "Spins played, by free or extra spin.")
+metrics.describe("gianky_prizes_total", "counter", "Prizes drawn, by prize.")
+
+# Asset statici precompressi e fingerprintati (compilati nel lifespan), con ETag e cache immutable
+static_assets = default_store()
+app.mount("/static", static_assets.app("/static"), name="static")
+app.mount("/dist", static_assets.app("/dist"), name="dist")
 
 # Rimuovi il mount duplicato alla root se presente (dall'ultimo tentativo)
 try:
@@ -65,16 +147,23 @@ except Exception as e:
 async def redirect_to_loading():
     return "/static/loading.html"
 
-@app.get("/index.html", response_class=HTMLResponse)
-async def index():
-    return FileResponse("static/index.html")
+@app.get("/index.html", response_class=HTMLResponse, include_in_schema=False)
+async def index(request: Request):
+    return static_assets.response(request, "/static", "index.html")
 
-# Configurazione ngrok
+# Configurazione ngrok (solo sviluppo: aperto dal lifespan, non all'import)
 NGROK_AUTH_TOKEN = os.getenv("NGROK_AUTH_TOKEN")
-if NGROK_AUTH_TOKEN:
-    ngrok.set_auth_token(NGROK_AUTH_TOKEN)
-    public_url = ngrok.connect(8000).public_url
-    logging.info(f"Ngrok tunnel URL: {public_url}")
+
+def start_tunnel():
+    # Con start_app.py il tunnel è del processo padre e sopravvive ai reload
+    if os.getenv("NGROK_PUBLIC_URL"):
+        logging.info(f"Ngrok tunnel URL: {os.getenv('NGROK_PUBLIC_URL')}")
+        return
+    if NGROK_AUTH_TOKEN:
+        from pyngrok import ngrok
+        ngrok.set_auth_token(NGROK_AUTH_TOKEN)
+        public_url = ngrok.connect(8000).public_url
+        logging.info(f"Ngrok tunnel URL: {public_url}")
 
 # ------------------ BLOCKCHAIN CONFIG ------------------
 PRIVATE_KEY = os.getenv("DISTRIBUTION_PRIVATE_KEY")
@@ -89,37 +178,75 @@ if not TOKEN_ADDRESS:
 WALLET_DISTRIBUZIONE = os.getenv("WALLET_DISTRIBUZIONE", "0xBc0c054066966a7A6C875981a18376e2296e5815")
 NFT_CONTRACT_ADDRESS = "0xdc91E2fD661E88a9a1bcB1c826B5579232fc9898"  # NFT contract address
 
-w3 = Web3(Web3.HTTPProvider(PROVIDER_URL))
-w3_no_mw = Web3(Web3.HTTPProvider(PROVIDER_URL))
-USED_TX = set()
+RPC_POOL_SIZE = int(os.getenv("RPC_POOL_SIZE", "20"))
+
+# Client RPC condiviso (sessione HTTP keep-alive, contratti creati una volta)
+chain = instrument_rpc(BlockchainClient(PROVIDER_URL, TOKEN_ADDRESS, NFT_CONTRACT_ADDRESS, pool_size=RPC_POOL_SIZE))
+
+# Cache saldi (per indirizzo checksum) e gas price, con coalescing delle richieste concorrenti
+# (con SHARED_STATE_URL i valori sono condivisi anche tra i worker uvicorn)
+balance_cache = TTLCache("balance", maxsize=int(os.getenv("BALANCE_CACHE_SIZE", "10000")), ttl=float(os.getenv("BALANCE_CACHE_TTL", "15")), shared=shared)
+gas_price_cache = TTLCache("gas_price", maxsize=1, ttl=float(os.getenv("GAS_PRICE_CACHE_TTL", "5")), shared=shared)
+
+def invalidate_balances(*addresses: str):
+    for address in addresses:
+        balance_cache.invalidate(checksum(address))
+
+# Pagamenti reali dei premi (disattivati = modalità test) e worker della coda
+PAYOUTS_ENABLED = os.getenv("PAYOUTS_ENABLED", "0") == "1"
+RUN_PAYOUT_WORKER = os.getenv("RUN_PAYOUT_WORKER", "1") == "1"
+
+def _on_payout_confirmed(payout):
+    invalidate_balances(payout.wallet, WALLET_DISTRIBUZIONE)
+
+# Accrediti differiti dei task (10 minuti), persistiti in scheduled_credits
+TASK_CREDIT_DELAY = int(os.getenv("TASK_CREDIT_DELAY", "600"))
+RUN_CREDIT_SCHEDULER = os.getenv("RUN_CREDIT_SCHEDULER", "1") == "1"
+credit_scheduler = CreditScheduler(on_applied=identities.invalidate_ids)
+
+# Storico premi: None = insert sincrono nella transazione dello spin (HISTORY_WRITE_MODE)
+prize_history = history_writer.from_env()
+if prize_history is not None:
+    metrics.gauge("gianky_prize_history", "Buffered prize history: pending rows, flushed rows, flushes, flush errors, spins rejected for backpressure.",
+                  prize_history.stats)
+
+async def admit_history(count: int = 1):
+    """Backpressure of the buffered history writer: 503 before the spin consumes anything."""
+    if prize_history is None or prize_history.has_room(count):
+        return
+    if not await asyncio.to_thread(prize_history.admit, count):
+        raise HTTPException(status_code=503, detail="Too many spins in progress, try again in a moment.",
+                            headers={"Retry-After": "1"})
 
 def to_wei(val, unit):
-    return Web3.to_wei(val, unit)
+    return _to_wei(val, unit)
 
 def from_wei(val, unit):
-    return Web3.from_wei(val, unit)
+    return _from_wei(val, unit)
+
+async def _fetch_gas_price():
+    base = await chain.gas_price()
+    safe = int(base * 1.2)
+    logging.info(f"Gas Price: {from_wei(base, 'gwei')} -> {from_wei(safe, 'gwei')}")
+    return safe
 
-def get_dynamic_gas_price():
+async def get_dynamic_gas_price():
     try:
-        try:
-            base = w3.eth.gas_price
-        except AttributeError:
-            base = w3.eth.get_gas_price()
-        safe = int(base * 1.2)
-        logging.info(f"Gas Price: {from_wei(base, 'gwei')} -> {from_wei(safe, 'gwei')}")
-        return safe
+        return await gas_price_cache.get_or_load("gas_price", _fetch_gas_price)
     except Exception as e:
         logging.error(f"Gas price error: {e}")
         return to_wei(50, 'gwei')
 
 # ------------------ TX VERIFICATION ------------------
-def verifica_transazione_gky(user_address: str, tx_hash: str, cost: int) -> bool:
+# Verifica dai log Transfer del receipt (mittente, destinatario, importo), con cache e batch RPC
+confirmations = ConfirmationEngine(chain, TOKEN_ADDRESS, WALLET_DISTRIBUZIONE)
+
+async def verifica_transazione_gky(user_address: str, tx_hash: str, cost: int) -> bool:
     try:
-        tx = w3_no_mw.eth.get_transaction(tx_hash)
-        if tx.get("to", "").lower() != TOKEN_ADDRESS.lower():
-            logging.error("TX not sent to the token contract.")
-            return False
-        return True
+        ok, reason = await confirmations.verify(tx_hash, user_address, cost)
+        if not ok:
+            logging.error(f"TX {tx_hash} rejected: {reason}")
+        return ok
     except Exception as e:
         logging.error(f"TX verification error: {e}")
         return False
@@ -133,12 +260,17 @@ def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta]
     to_encode = data.copy()
     expire = datetime.datetime.utcnow() + (expires_delta or datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({"exp": expire})
+    from jose import jwt
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 # ------------------ INPUT MODELS ------------------
 class SpinRequest(BaseModel):
     wallet_address: str = Field(..., pattern="^0x[a-fA-F0-9]{40}$")
 
+class SpinBatchRequest(BaseModel):
+    wallet_address: str = Field(..., pattern="^0x[a-fA-F0-9]{40}$")
+    count: int = Field(..., description="Number of spins to play at once", gt=0)
+
 class BuySpinsRequest(BaseModel):
     wallet_address: str = Field(..., pattern="^0x[a-fA-F0-9]{40}$")
     num_spins: int = Field(..., description="Number of extra spins (1, 3, or 10)", gt=0)
@@ -163,20 +295,18 @@ class TaskClaimRequest(BaseModel):
 # ------------------ NEW ENDPOINT: CLAIMED TASKS ------------------
 @app.get("/api/claimed_tasks/{wallet_address}")
 async def claimed_tasks(wallet_address: str):
-    user = get_user(wallet_address)
-    tasks = user.last_claimed_tasks
-    claimed = tasks.split(",") if tasks and tasks.strip() != "" else []
-    return {"claimed_tasks": claimed}
+    try:
+        return {"claimed_tasks": list(identities.claimed_tasks(wallet_address))}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid wallet address.")
 
 # ------------------ ENDPOINT: SPINS STATUS ------------------
 @app.get("/api/spins_status/{wallet_address}")
 async def spins_status(wallet_address: str):
     user = get_user(wallet_address)
-    italy = pytz.timezone("Europe/Rome")
-    now_date = datetime.datetime.now(italy).date()
-    free_spin = 1 if (getattr(user, "last_free_spin_date", None) is None or user.last_free_spin_date < now_date) else 0
-    available = user.extra_spins + free_spin
-    return {"available_spins": available}
+    if user is None:
+        raise HTTPException(status_code=400, detail="Invalid wallet address.")
+    return {"available_spins": user.available_spins()}
 
 # ------------------ ENDPOINT: GRANT TEST SPINS ------------------
 @app.post("/api/grant_test_spins")
@@ -187,14 +317,16 @@ async def grant_test_spins(wallet_address: str = "0xTestWallet000000000000000000
         if user is None:
              raise HTTPException(status_code=500, detail="Could not get or create user.")
 
-        user.extra_spins += 5
+        # Lo snapshot è in sola lettura: l'incremento va sul DB
+        session_db.query(User).filter(User.id == user.id).update(
+            {User.extra_spins: User.extra_spins + 5}, synchronize_session=False)
         session_db.commit()
+        identities.invalidate(user.wallet_address)
         logging.info(f"Granted 5 test spins to {wallet_address}")
-        italy = pytz.timezone("Europe/Rome")
-        now_date = datetime.datetime.now(italy).date()
-        current_free_spin = 1 if (getattr(user, "last_free_spin_date", None) is None or user.last_free_spin_date < now_date) else 0
-        available = user.extra_spins + current_free_spin
+        available = get_user(wallet_address).available_spins()
         return {"message": "5 test spins granted.", "available_spins": available}
+    except HTTPException:
+        raise
     except Exception as e:
         session_db.rollback()
         logging.error(f"Error granting test spins: {e}")
@@ -206,208 +338,203 @@ async def grant_test_spins(wallet_address: str = "0xTestWallet000000000000000000
 @app.get("/api/balance/{wallet_address}")
 async def get_balance(wallet_address: str):
     try:
-        provider = Web3(Web3.HTTPProvider(PROVIDER_URL))
-        checksum_address = provider.to_checksum_address(wallet_address)
-        matic_balance = provider.eth.get_balance(checksum_address)
-        token_contract = provider.eth.contract(
-            address=TOKEN_ADDRESS,
-            abi=[{
-                "constant": True,
-                "inputs": [{"name": "owner", "type": "address"}],
-                "name": "balanceOf",
-                "outputs": [{"name": "", "type": "uint256"}],
-                "payable": False,
-                "stateMutability": "view",
-                "type": "function"
-            }]
-        )
-        token_balance = token_contract.functions.balanceOf(checksum_address).call()
-        return {"matic": float(from_wei(matic_balance, 'ether')), "gky": float(from_wei(token_balance, 'ether'))}
+        checksum_address = checksum(wallet_address)
+        return await balance_cache.get_or_load(checksum_address, lambda: _fetch_balances(checksum_address))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _fetch_balances(checksum_address: str) -> dict:
+    matic_balance, token_balance = await asyncio.gather(
+        chain.native_balance(checksum_address),
+        chain.token_balance(checksum_address),
+    )
+    return {"matic": float(from_wei(matic_balance, 'ether')), "gky": float(from_wei(token_balance, 'ether'))}
+
+@app.get("/api/cache_stats")
+async def cache_stats():
+    return {"balance": balance_cache.stats(), "gas_price": gas_price_cache.stats(), "receipts": confirmations.stats(),
+            "identities": identities.stats(), "prize_history": prize_history.stats() if prize_history is not None else None}
+
 # ------------------ TOKEN TRANSFER ------------------
-def invia_token(destinatario: str, quantita: int) -> bool:
-    try:
-        checksum_destinatario = w3.to_checksum_address(destinatario)
-        gas_price = get_dynamic_gas_price()
-        token_contract = w3.eth.contract(
-            address=TOKEN_ADDRESS,
-            abi=[{
-                "constant": False,
-                "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
-                "name": "transfer",
-                "outputs": [{"name": "", "type": "bool"}],
-                "payable": False,
-                "stateMutability": "nonpayable",
-                "type": "function"
-            }]
-        )
-        nonce = w3.eth.get_transaction_count(WALLET_DISTRIBUZIONE)
-        tx = token_contract.functions.transfer(checksum_destinatario, quantita * 10**18).build_transaction({
-            'from': WALLET_DISTRIBUZIONE,
-            'nonce': nonce,
-            'gas': 100000,
-            'gasPrice': gas_price,
-        })
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
-        raw_tx = signed_tx.raw_transaction if hasattr(signed_tx, 'raw_transaction') else signed_tx.rawTransaction
-        tx_hash = w3.eth.send_raw_transaction(raw_tx)
-        logging.info(f"Tokens sent to {checksum_destinatario}: {quantita} GKY, txHash: {tx_hash.hex()}")
-    except Exception as e:
-        logging.error(f"Error sending tokens: {e}")
-        return False
+async def invia_token(destinatario: str, quantita: int) -> bool:
+    """Queues a GKY transfer; the payout worker assigns the nonce and broadcasts it."""
     session_db = Session()
     try:
-        counter = session_db.query(GlobalCounter).first()
-        if counter is None:
-            counter = GlobalCounter(total_in=0.0, total_out=quantita)
-            session_db.add(counter)
-        else:
-            counter.total_out += quantita
+        checksum_destinatario = checksum(destinatario)
+        enqueue_payout(session_db, "token", checksum_destinatario, amount=quantita)
         session_db.commit()
+        payout_worker.notify()
+        logging.info(f"Token payout queued for {checksum_destinatario}: {quantita} GKY")
+        return True
     except Exception as e:
-        logging.error(f"Error updating total_out: {e}")
         session_db.rollback()
+        logging.error(f"Error queuing tokens: {e}")
+        return False
     finally:
         session_db.close()
-    return True
 
 # ------------------ NFT SENDING LOGIC ------------------
-def send_nft(destinatario: str) -> bool:
+async def send_nft(destinatario: str) -> bool:
     """
-    Sends one NFT randomly chosen (from token IDs 1 to 11) from the distribution wallet.
-    Uses the ERC721 safeTransferFrom function.
+    Queues one NFT randomly chosen (from token IDs 1 to 11) from the distribution wallet.
+    The payout worker sends it with the ERC721 safeTransferFrom function.
     """
+    session_db = Session()
     try:
-        checksum_destinatario = w3.to_checksum_address(destinatario)
-        nft_contract = w3.eth.contract(
-            address=NFT_CONTRACT_ADDRESS,
-            abi=[{
-                "constant": False,
-                "inputs": [
-                    {"name": "from", "type": "address"},
-                    {"name": "to", "type": "address"},
-                    {"name": "tokenId", "type": "uint256"}
-                ],
-                "name": "safeTransferFrom",
-                "outputs": [],
-                "payable": False,
-                "stateMutability": "nonpayable",
-                "type": "function"
-            }]
-        )
+        checksum_destinatario = checksum(destinatario)
         token_id = random.randint(1, 11)
-        gas_price = get_dynamic_gas_price()
-        nonce = w3.eth.get_transaction_count(WALLET_DISTRIBUZIONE)
-        tx = nft_contract.functions.safeTransferFrom(WALLET_DISTRIBUZIONE, checksum_destinatario, token_id).build_transaction({
-            'from': WALLET_DISTRIBUZIONE,
-            'nonce': nonce,
-            'gas': 200000,
-            'gasPrice': gas_price,
-        })
-        signed_tx = w3.eth.account.sign_transaction(tx, PRIVATE_KEY)
-        raw_tx = signed_tx.raw_transaction if hasattr(signed_tx, 'raw_transaction') else signed_tx.rawTransaction
-        tx_hash = w3.eth.send_raw_transaction(raw_tx)
-        logging.info(f"NFT (tokenId {token_id}) sent to {destinatario}, txHash: {tx_hash.hex()}")
+        enqueue_payout(session_db, "nft", checksum_destinatario, token_id=token_id)
+        session_db.commit()
+        payout_worker.notify()
+        logging.info(f"NFT payout (tokenId {token_id}) queued for {destinatario}")
         return True
     except Exception as e:
-        logging.error(f"Error sending NFT: {e}")
+        session_db.rollback()
+        logging.error(f"Error queuing NFT: {e}")
         return False
+    finally:
+        session_db.close()
+
+def enqueue_prize(session, wallet: str, premio: str) -> bool:
+    """Adds the payout for a won prize to the spin's own session (committed with it)."""
+    name = premio.strip().upper()
+    if name.endswith("GKY"):
+        enqueue_payout(session, "token", wallet, amount=int(name.split()[0]))
+        return True
+    if "NFT" in name:
+        enqueue_payout(session, "nft", wallet, token_id=random.randint(1, 11))
+        return True
+    return False
+
+payout_worker = PayoutWorker(
+    chain, PRIVATE_KEY, WALLET_DISTRIBUZIONE,
+    batch_size=int(os.getenv("PAYOUT_BATCH_SIZE", "20")),
+    gas_price=get_dynamic_gas_price,
+    on_confirmed=_on_payout_confirmed,
+    lease=DatabaseLease("payout_worker"),
+)
+
+metrics.gauge("gianky_payout_queue_depth", "Payouts by status: pending (to send), sent (awaiting receipt), failed (reverted, needs manual review).", queue_depth)
+
+@app.get("/api/payouts/status")
+async def payouts_status():
+    return queue_depth()
+
+def _check_metrics_token(token: Optional[str]):
+    if METRICS_TOKEN and token != METRICS_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid metrics token.")
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint(x_metrics_token: Optional[str] = Header(None)):
+    _check_metrics_token(x_metrics_token)
+    # Il gauge della coda legge dal DB: fuori dal loop
+    body = await asyncio.to_thread(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/profiles", include_in_schema=False)
+async def metrics_profiles(x_metrics_token: Optional[str] = Header(None)):
+    _check_metrics_token(x_metrics_token)
+    return {"profiles": list(profiler.reports)}
 
 # ------------------ PRIZE ASSIGNMENT ------------------
 def get_prize() -> str:
-    prizes = [
-        ("10 GKY", 37.075),
-        ("20 GKY", 15),
-        ("50 GKY", 10),
-        ("100 GKY", 1.50),
-        ("NFTSTARTER", 0.025),
-        ("500 GKY", 0.25),
-        ("1000 GKY", 0.25),
-        ("NO PRIZE", 40.50)
-    ]
-    total = sum(weight for _, weight in prizes)
-    r = random.uniform(0, total)
-    upto = 0
-    for prize, weight in prizes:
-        if upto + weight >= r:
-            logging.info(f"get_prize() selected: {prize}")
-            return prize
-        upto += weight
-    logging.info("get_prize() selected: NO PRIZE")
-    return "NO PRIZE"
+    return prize_engine.draw()
 
 # ------------------ GET USER ------------------
 def get_user(wallet_address: str):
-    session_db = Session()
+    """Read-only UserSnapshot from the identity cache (created on first sight); None on error."""
     try:
-        checksum_address = w3.to_checksum_address(wallet_address)
-        user = session_db.query(User).filter_by(wallet_address=checksum_address).first()
-        if not user:
-            user = User(wallet_address=checksum_address, extra_spins=0, last_free_spin_date=None, last_claimed_tasks="")
-            session_db.add(user)
-            session_db.commit()
-            logging.info(f"New user created: {checksum_address}")
-        return user
+        return identities.resolve(wallet_address)
     except Exception as e:
-        session_db.rollback()
         logging.error(f"Error getting or creating user for {wallet_address}: {e}")
-        # Depending on desired behavior, you might want to raise HTTPException here
-        # raise HTTPException(status_code=500, detail=str(e))
-        return None # Or handle as appropriate
-    finally:
-        session_db.close()
+        return None
+
+# ------------------ IDEMPOTENCY ------------------
+# Doppi tap dalla webview: il duplicato (stessa Idempotency-Key o, per confirmbuy/claim_referral,
+# stesso body a breve distanza) riceve il risultato della prima esecuzione invece di rifare DB e RPC
+idempotency = idempotency_from_env(shared=shared)
+metrics.describe("gianky_idempotent_replays_total", "counter", "Duplicate requests answered with the first execution's result, by route.")
+
+async def run_idempotent(route: str, req: BaseModel, key: Optional[str], response: Response, handler, derive: bool = False):
+    try:
+        result, replayed = await idempotency.run(route, req.wallet_address, key, req.model_dump(), handler, derive=derive)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+        metrics.inc("gianky_idempotent_replays_total", route=route)
+    return result
 
 # ------------------ ENDPOINT: SPIN ------------------
+def spin_message(premio: str, queued: bool) -> str:
+    if premio.strip().upper() == "NO PRIZE":
+        return "No prize won. Try again!"
+    if queued:
+        return f"You won {premio}! It is on its way to your wallet."
+    # Simuliamo il premio senza inviarlo realmente
+    if "GKY" in premio:
+        return f"You won {premio}! (Test mode - no tokens sent)"
+    if "NFT" in premio:
+        return "Congratulations! You won an NFT Starter! (Test mode - no NFT sent)"
+    return f"You won: {premio}!"
+
 @app.post("/api/spin")
-async def api_spin(req: SpinRequest):
-    user = get_user(req.wallet_address)
-    session = Session()
+async def api_spin(req: SpinRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    # Due spin con lo stesso body sono due giocate: si deduplica solo con l'header
+    return await run_idempotent("spin", req, idempotency_key, response, lambda: _spin(req))
+
+async def _spin(req: SpinRequest):
+    await admit_history(1)
     try:
-        user = session.merge(user)
-        italy = pytz.timezone("Europe/Rome")
-        now_date = datetime.datetime.now(italy).date()
-        free_spin_available = 1 if (getattr(user, "last_free_spin_date", None) is None or user.last_free_spin_date < now_date) else 0
-        if free_spin_available == 0 and user.extra_spins <= 0:
-            raise HTTPException(status_code=400, detail="You have no spins left for today.")
-        if free_spin_available == 1:
-            user.last_free_spin_date = now_date
-            session.commit()
-        else:
-            user.extra_spins -= 1
-            session.commit()
-        premio = get_prize()
-        
-        # Simuliamo il premio senza inviarlo realmente
-        if premio.strip().upper() == "NO PRIZE":
-            result_text = "No prize won. Try again!"
-        elif "GKY" in premio:
-            result_text = f"You won {premio}! (Test mode - no tokens sent)"
-        elif "NFT" in premio:
-            result_text = "Congratulations! You won an NFT Starter! (Test mode - no NFT sent)"
-        else:
-            result_text = f"You won: {premio}!"
-            
-        # Registriamo comunque il premio nel database
-        record = PremioVinto(
-            telegram_id=user.telegram_id or "N/A",
-            wallet=user.wallet_address,
-            premio=premio,
-            user_id=user.id
-        )
-        session.add(record)
-        session.commit()
-        
-        logging.info(f"Spin for {req.wallet_address}: prize {premio} (Test mode)")
-        current_free_spin = 1 if (getattr(user, "last_free_spin_date", None) is None or user.last_free_spin_date < now_date) else 0
-        available = user.extra_spins + current_free_spin
-        return {"message": result_text, "prize": premio, "available_spins": available}
+        checksum_address = checksum(req.wallet_address)
+        # Controllo, decremento, estrazione e storico in un'unica transazione
+        result = perform_spin(checksum_address, allowance.today(), get_prize, enqueue=enqueue_prize if PAYOUTS_ENABLED else None,
+                              history=prize_history)
+        identities.invalidate(checksum_address)
+        premio = result["prize"]
+        if result["queued"]:
+            payout_worker.notify()
+        metrics.inc("gianky_spins_total", kind="free" if result["free_spin"] else "extra")
+        metrics.inc("gianky_prizes_total", prize=premio)
+        logging.debug(f"Spin for {req.wallet_address}: prize {premio}" + ("" if result["queued"] else " (Test mode)"))
+        return {"message": spin_message(premio, result["queued"]), "prize": premio, "available_spins": result["available_spins"]}
+    except NoSpinsLeft:
+        raise HTTPException(status_code=400, detail="You have no spins left for today.")
     except Exception as e:
         logging.error(f"Error during spin: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        session.close()
+
+# ------------------ ENDPOINT: SPIN BATCH ------------------
+SPIN_BATCH_MAX = int(os.getenv("SPIN_BATCH_MAX", "50"))
+
+@app.post("/api/spin_batch")
+async def api_spin_batch(req: SpinBatchRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent("spin_batch", req, idempotency_key, response, lambda: _spin_batch(req))
+
+async def _spin_batch(req: SpinBatchRequest):
+    if req.count > SPIN_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"You can play at most {SPIN_BATCH_MAX} spins at once.")
+    await admit_history(req.count)
+    try:
+        checksum_address = checksum(req.wallet_address)
+        # Prenotazione degli n giri, estrazioni e storico in un'unica transazione
+        result = perform_spin_batch(checksum_address, allowance.today(), req.count, prize_engine.draw_many,
+                                    enqueue=enqueue_prize if PAYOUTS_ENABLED else None, history=prize_history)
+        identities.invalidate(checksum_address)
+        if any(result["queued"]):
+            payout_worker.notify()
+        results = []
+        for i, (premio, queued) in enumerate(zip(result["prizes"], result["queued"])):
+            metrics.inc("gianky_spins_total", kind="free" if result["free_spin"] and i == 0 else "extra")
+            metrics.inc("gianky_prizes_total", prize=premio)
+            results.append({"prize": premio, "message": spin_message(premio, queued)})
+        logging.debug(f"Spin batch for {req.wallet_address}: {result['prizes']}")
+        return {"results": results, "available_spins": result["available_spins"]}
+    except NoSpinsLeft:
+        raise HTTPException(status_code=400, detail=f"You do not have {req.count} spins available.")
+    except Exception as e:
+        logging.error(f"Error during spin batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 # ------------------ ENDPOINT: BUY SPINS ------------------
 @app.post("/api/buyspins")
@@ -426,47 +553,50 @@ async def api_buyspins(req: BuySpinsRequest):
 
 # ------------------ ENDPOINT: CONFIRM BUY ------------------
 @app.post("/api/confirmbuy")
-async def api_confirmbuy(req: ConfirmBuyRequest):
+async def api_confirmbuy(req: ConfirmBuyRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    # Il tx_hash è una chiave naturale: un doppio invio senza header si deduplica comunque
+    return await run_idempotent("confirmbuy", req, idempotency_key, response, lambda: _confirmbuy(req), derive=True)
+
+async def _confirmbuy(req: ConfirmBuyRequest):
     user = get_user(req.wallet_address)
     session = Session()
     try:
-        if req.tx_hash in USED_TX:
+        # Pagamento già trovato e accreditato dall'indexer: basta una lettura dal DB
+        payment = find_payment(req.tx_hash)
+        if payment is not None and payment.credited:
+            if payment.sender != user.wallet_address.lower():
+                raise HTTPException(status_code=400, detail="TX not valid or insufficient amount.")
+            # Accreditato da un altro processo: lo snapshot in cache può non includerlo
+            identities.invalidate(user.wallet_address)
+            user = get_user(req.wallet_address)
+            return {"message": f"Purchase already credited! Extra spins: {user.extra_spins}", "available_spins": user.available_spins()}
+        if ledger.is_consumed(req.tx_hash):
             raise HTTPException(status_code=400, detail="TX already used for a purchase.")
         if req.num_spins not in (1, 3, 10):
             raise HTTPException(status_code=400, detail="You can only confirm 1, 3, or 10 extra spins.")
         cost = 50 if req.num_spins == 1 else 125 if req.num_spins == 3 else 300
         if not user.wallet_address:
             raise HTTPException(status_code=400, detail="Connect your wallet before confirming.")
-        if not verifica_transazione_gky(user.wallet_address, req.tx_hash, cost):
+        if not await verifica_transazione_gky(user.wallet_address, req.tx_hash, cost):
             raise HTTPException(status_code=400, detail="TX not valid or insufficient amount.")
-        USED_TX.add(req.tx_hash)
-        user = session.merge(user)
-        user.extra_spins += req.num_spins
+        # Consumo del tx, accredito e contatore nella stessa transazione: un replay viene rifiutato dal DB
+        ledger.consume(session, req.tx_hash, user_id=user.id)
+        session.query(User).filter(User.id == user.id).update(
+            {User.extra_spins: User.extra_spins + req.num_spins}, synchronize_session=False)
+        counters.add(total_in=cost, session=session)
         session.commit()
-        session.refresh(user)
+        ledger.committed(req.tx_hash)
+        identities.invalidate(user.wallet_address)
+        user = session.get(User, user.id)
         logging.info(f"Extra spins updated for {req.wallet_address}: {user.extra_spins}")
-        session_gc = Session()
-        try:
-            counter = session_gc.query(GlobalCounter).first()
-            if counter is None:
-                counter = GlobalCounter(total_in=cost, total_out=0.0)
-                session_gc.add(counter)
-            else:
-                counter.total_in += cost
-            session_gc.commit()
-        except Exception as gc_e:
-            logging.error(f"Error updating total_in: {gc_e}")
-            session_gc.rollback()
-        finally:
-            session_gc.close()
-        italy = pytz.timezone("Europe/Rome")
-        now_date = datetime.datetime.now(italy).date()
-        current_free_spin = 1 if (getattr(user, "last_free_spin_date", None) is None or user.last_free_spin_date < now_date) else 0
-        available = user.extra_spins + current_free_spin
+        available = allowance.available_spins(user)
         return {"message": f"Purchase confirmed! Extra spins: {user.extra_spins}", "available_spins": available}
     except HTTPException as he:
         session.rollback()
         raise he
+    except TxAlreadyUsed:
+        session.rollback()
+        raise HTTPException(status_code=400, detail="TX already used for a purchase.")
     except Exception as e:
         session.rollback()
         logging.error(f"Error in confirmbuy: {e}")
@@ -476,32 +606,30 @@ async def api_confirmbuy(req: ConfirmBuyRequest):
 
 # ------------------ ENDPOINT: CLAIM REFERRAL ------------------
 @app.post("/api/claim_referral")
-async def claim_referral(req: ReferralRequest):
+async def claim_referral(req: ReferralRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    return await run_idempotent("claim_referral", req, idempotency_key, response, lambda: _claim_referral(req), derive=True)
+
+async def _claim_referral(req: ReferralRequest):
     new_user = get_user(req.wallet_address)
+    # Disallow self-referral
+    if new_user.wallet_address.lower() == req.referrer.lower():
+        return {"message": "You cannot refer yourself."}
+    ref_user = get_user(req.referrer)
     session = Session()
     try:
-        # Disallow self-referral
-        if new_user.wallet_address.lower() == req.referrer.lower():
-            return {"message": "You cannot refer yourself."}
-        # Process referral only if not already registered for the referee
-        if not getattr(new_user, "referred_by", None) or new_user.referred_by.strip() == "":
-            new_user.referred_by = req.referrer
-            session.commit()
-            # Credit the referrer with 2 free spins
-            ref_user = get_user(req.referrer)
-            ref_session = Session()
-            try:
-                ref_user = ref_session.merge(ref_user)
-                ref_user.extra_spins += 2
-                ref_session.commit()
-            except Exception as e:
-                ref_session.rollback()
-                logging.error(f"Error crediting referrer: {e}")
-            finally:
-                ref_session.close()
-            return {"message": "Referral recorded. (Referrer credited with 2 free spins.)"}
-        else:
-            return {"message": "Referral already recorded for this user."}
+        # Il vincolo unique su referrals.referee_id rifiuta un secondo referral per lo stesso utente
+        session.add(Referral(referee_id=new_user.id, referrer_id=ref_user.id, referrer_wallet=ref_user.wallet_address))
+        session.query(User).filter(User.id == new_user.id).update(
+            {User.referred_by: ref_user.wallet_address}, synchronize_session=False)
+        # Credit the referrer with 2 free spins (same transaction)
+        session.query(User).filter(User.id == ref_user.id).update(
+            {User.extra_spins: User.extra_spins + 2}, synchronize_session=False)
+        session.commit()
+        identities.invalidate(new_user.wallet_address, ref_user.wallet_address)
+        return {"message": "Referral recorded. (Referrer credited with 2 free spins.)"}
+    except IntegrityError:
+        session.rollback()
+        return {"message": "Referral already recorded for this user."}
     except Exception as e:
         session.rollback()
         logging.error(f"Error in claim_referral: {e}")
@@ -511,22 +639,20 @@ async def claim_referral(req: ReferralRequest):
 
 # ------------------ ENDPOINT: CLAIM TASK ------------------
 @app.post("/api/claim_task")
-async def claim_task(req: TaskClaimRequest, background_tasks: BackgroundTasks):
+async def claim_task(req: TaskClaimRequest):
     user = get_user(req.wallet_address)
     session = Session()
     try:
-        user = session.merge(user)
-        claimed = user.last_claimed_tasks.split(",") if getattr(user, "last_claimed_tasks", None) else []
-        if req.task_id in claimed:
-            raise HTTPException(status_code=400, detail="Task already claimed.")
-        claimed.append(req.task_id)
-        user.last_claimed_tasks = ",".join(claimed)
+        session.add(TaskClaim(user_id=user.id, task_id=req.task_id))
+        # Accredito differito persistito nella stessa transazione del claim
+        credit_scheduler.schedule(session, user.id, 2, TASK_CREDIT_DELAY, reason=f"task:{req.task_id}")
         session.commit()
-        background_tasks.add_task(process_task_claim, req.wallet_address)
+        identities.invalidate(user.wallet_address)
+        credit_scheduler.notify()
         return {"message": "Task completed! You will receive 2 extra spins within 10 minutes."}
-    except HTTPException as he:
+    except IntegrityError:
         session.rollback()
-        raise he
+        raise HTTPException(status_code=400, detail="Task already claimed.")
     except Exception as e:
         session.rollback()
         logging.error(f"Error in claim_task: {e}")
@@ -534,20 +660,56 @@ async def claim_task(req: TaskClaimRequest, background_tasks: BackgroundTasks):
     finally:
         session.close()
 
-async def process_task_claim(wallet_address: str):
-    await asyncio.sleep(600)  # 10 minutes
-    session = Session()
-    try:
-        user = session.query(User).filter(User.wallet_address.ilike(wallet_address)).first()
-        if user:
-            user.extra_spins += 2
-            session.commit()
-            logging.info(f"Task claim process: 2 extra spins credited for {wallet_address}")
-    except Exception as e:
-        session.rollback()
-        logging.error(f"Error in process_task_claim: {e}")
-    finally:
-        session.close()
+# ------------------ ADMIN: ANALYTICS ------------------
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def _check_admin_token(token: Optional[str]):
+    # Senza ADMIN_TOKEN configurato gli endpoint admin restano chiusi
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+def _day_range(days: int):
+    until = datetime.datetime.utcnow().date()
+    return until - datetime.timedelta(days=days - 1), until
+
+@app.get("/api/admin/prizes_by_day", include_in_schema=False)
+async def admin_prizes_by_day(days: int = Query(7, gt=0, le=366), x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    return {"days": await asyncio.to_thread(analytics.prizes_by_day, *_day_range(days))}
+
+@app.get("/api/admin/top_winners", include_in_schema=False)
+async def admin_top_winners(days: int = Query(7, gt=0, le=366), limit: int = Query(10, gt=0, le=1000),
+                            x_admin_token: Optional[str] = Header(None)):
+    _check_admin_token(x_admin_token)
+    return {"winners": await asyncio.to_thread(analytics.top_winners, *_day_range(days), limit)}
+
+@app.get("/api/admin/export", include_in_schema=False)
+async def admin_export(format: str = Query("csv", pattern="^(csv|ndjson)$"),
+                       since: Optional[datetime.date] = None, until: Optional[datetime.date] = None,
+                       x_admin_token: Optional[str] = Header(None)):
+    """Streams premi_vinti (UTC days, `until` inclusive) without loading it in memory."""
+    _check_admin_token(x_admin_token)
+    rows = analytics.iter_history(
+        since=datetime.datetime.combine(since, datetime.time.min) if since else None,
+        until=datetime.datetime.combine(until + datetime.timedelta(days=1), datetime.time.min) if until else None,
+    )
+    # Generatore sincrono: Starlette lo consuma in un thread, fuori dal loop
+    if format == "ndjson":
+        return StreamingResponse(analytics.export_ndjson(rows), media_type="application/x-ndjson")
+    return StreamingResponse(analytics.export_csv(rows), media_type="text/csv",
+                             headers={"Content-Disposition": 'attachment; filename="premi_vinti.csv"'})
+
+# ------------------ TELEGRAM WEBHOOK ------------------
+# Con BOT_WEBHOOK_URL il bot gira nel processo web e riceve gli update qui (niente long polling)
+telegram_bot = None
+if os.getenv("BOT_WEBHOOK_URL"):
+    import bot as telegram_bot
+
+    @app.post(telegram_bot.BOT_WEBHOOK_PATH, include_in_schema=False)
+    async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+        if not await telegram_bot.handle_webhook(await request.json(), x_telegram_bot_api_secret_token):
+            raise HTTPException(status_code=403, detail="Invalid webhook secret.")
+        return {"ok": True}
 
 # ------------------ ENDPOINT: DISTRIBUTE ------------------
 @app.post("/api/distribute")
@@ -563,18 +725,6 @@ async def api_referral(wallet_address: str):
     referral_link = f"https://t.me/giankytestbot?start=ref_{wallet_address}"
     return {"referral_link": referral_link}
 
-@app.get("/static/loading.html", response_class=HTMLResponse)
-async def loading():
-    response = FileResponse("static/loading.html")
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    return response
-
-@app.get("/index.html", response_class=HTMLResponse)
-async def index():
-    return FileResponse("static/index.html")
-
 @app.get("/api/restart")
 async def restart_server():
     """Endpoint per riavviare il server"""
@@ -586,4 +736,5 @@ async def restart_server():
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=5000)
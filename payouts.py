@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – payouts.py
+--------------------------------
+Payout pipeline for the distribution wallet:
+ • Prizes are enqueued as rows in the `payouts` table (durable)
+ • One async worker keeps the wallet nonce locally (no RPC per send)
+ • Batches are signed locally, persisted, then broadcast in parallel
+ • Receipts are tracked; stuck transactions are replaced with a higher fee
+ • Database work runs in worker threads (asyncio.to_thread), never on the event loop;
+   reverted payouts stay "failed" for manual review and are counted by queue_depth()
+"""
+
+import asyncio, datetime, logging
+from typing import Callable, List, Optional
+
+from counters import counters
+from database import Session, Payout
+
+# ------------------ ENQUEUE ------------------
+def enqueue_payout(session, kind: str, wallet: str, amount: Optional[int] = None, token_id: Optional[int] = None) -> Payout:
+    """Adds a payout to the caller's session; it is durable once the caller commits."""
+    payout = Payout(kind=kind, wallet=wallet, amount=amount, token_id=token_id, status="pending", attempts=0)
+    session.add(payout)
+    return payout
+
+def queue_depth() -> dict:
+    session = Session()
+    try:
+        pending = session.query(Payout).filter(Payout.status == "pending").count()
+        sent = session.query(Payout).filter(Payout.status == "sent").count()
+        failed = session.query(Payout).filter(Payout.status == "failed").count()
+        return {"pending": pending, "sent": sent, "failed": failed}
+    finally:
+        session.close()
+
+# ------------------ NONCE ------------------
+class NonceManager:
+    """Hands out consecutive nonces without asking the node each time."""
+
+    def __init__(self, chain, address: str):
+        self.chain = chain
+        self.address = address
+        self._next: Optional[int] = None
+
+    async def sync(self, floor: int = 0):
+        chain_nonce = await self.chain.transaction_count(self.address, "pending")
+        self._next = max(chain_nonce, floor)
+        logging.info(f"Nonce manager synced at {self._next} for {self.address}")
+
+    def next(self) -> int:
+        nonce = self._next
+        self._next += 1
+        return nonce
+
+    def reset(self):
+        self._next = None
+
+    @property
+    def ready(self) -> bool:
+        return self._next is not None
+
+# ------------------ WORKER ------------------
+class PayoutWorker:
+    """Single consumer of the payouts table; run exactly one per distribution wallet."""
+
+    def __init__(self, chain, private_key: str, wallet: str,
+                 batch_size: int = 20, poll_interval: float = 2.0,
+                 replace_after: float = 90.0, fee_bump: float = 1.125, max_gas_price: Optional[int] = None,
+                 gas_price: Optional[Callable] = None, on_confirmed: Optional[Callable[[Payout], None]] = None,
+                 lease=None):
+        self.chain = chain
+        self.private_key = private_key
+        self.wallet = wallet
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.replace_after = replace_after
+        self.fee_bump = fee_bump
+        self.max_gas_price = max_gas_price
+        self.gas_price = gas_price or chain.gas_price
+        self.on_confirmed = on_confirmed
+        self.nonces = NonceManager(chain, wallet)
+        # Con più processi solo chi detiene il lease invia (un solo gestore del nonce)
+        self.lease = lease
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.lease is not None:
+            await asyncio.to_thread(self.lease.release)
+
+    def notify(self):
+        """Wakes the worker right away after an enqueue instead of waiting for the next poll."""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                if self.lease is not None and not await asyncio.to_thread(self.lease.acquire):
+                    self.nonces.reset()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                if not self.nonces.ready:
+                    await self.nonces.sync(await asyncio.to_thread(self._highest_db_nonce) + 1)
+                await self.send_pending()
+                await self.track_sent()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Payout worker error: {e}")
+                self.nonces.reset()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _highest_db_nonce(self) -> int:
+        session = Session()
+        try:
+            row = (session.query(Payout.nonce)
+                   .filter(Payout.status == "sent", Payout.nonce.isnot(None))
+                   .order_by(Payout.nonce.desc()).first())
+            return row[0] if row else -1
+        finally:
+            session.close()
+
+    async def _build(self, payout: Payout, gas_price: int) -> dict:
+        params = {'from': self.wallet, 'nonce': payout.nonce, 'gasPrice': gas_price}
+        if payout.kind == "nft":
+            params['gas'] = 200000
+            fn = self.chain.nft.functions.safeTransferFrom(self.wallet, payout.wallet, payout.token_id)
+        else:
+            params['gas'] = 100000
+            fn = self.chain.token.functions.transfer(payout.wallet, payout.amount * 10**18)
+        return await fn.build_transaction(params)
+
+    # ------------------ SEND ------------------
+    def _pending_batch(self, session) -> List[Payout]:
+        return (session.query(Payout).filter(Payout.status == "pending")
+                .order_by(Payout.id).limit(self.batch_size).all())
+
+    async def send_pending(self) -> int:
+        await self.chain.start()
+        # Niente expire dopo il commit: leggere un attributo non deve rifare query sull'event loop
+        session = Session(expire_on_commit=False)
+        try:
+            batch = await asyncio.to_thread(self._pending_batch, session)
+            if not batch:
+                return 0
+            gas_price = await self.gas_price()
+            raw_txs = []
+            # Firma locale + salvataggio prima dell'invio: un crash non perde il nonce assegnato
+            for payout in batch:
+                payout.nonce = self.nonces.next()
+                payout.gas_price = gas_price
+                tx = await self._build(payout, gas_price)
+                payout.tx_hash, raw_tx = self.chain.sign(tx, self.private_key)
+                payout.status = "sent"
+                payout.sent_at = datetime.datetime.utcnow()
+                payout.attempts = (payout.attempts or 0) + 1
+                raw_txs.append(raw_tx)
+            await asyncio.to_thread(session.commit)
+            results = await asyncio.gather(*(self.chain.send_raw(raw) for raw in raw_txs), return_exceptions=True)
+            for payout, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self._handle_send_error(payout, result)
+            await asyncio.to_thread(session.commit)
+            logging.info(f"Payout batch broadcast: {len(batch)} transactions")
+            return len(batch)
+        except Exception:
+            await asyncio.to_thread(session.rollback)
+            raise
+        finally:
+            session.close()
+
+    def _handle_send_error(self, payout: Payout, error: Exception):
+        message = str(error).lower()
+        payout.last_error = str(error)[:500]
+        if "already known" in message:
+            return
+        if "nonce too low" in message:
+            # Nonce consumato altrove: il pagamento torna in coda con un nuovo nonce
+            payout.status = "pending"
+            payout.nonce = None
+            payout.tx_hash = None
+            self.nonces.reset()
+        # Per gli altri errori il tx resta "sent": track_sent lo ritrasmetterà
+        logging.error(f"Payout {payout.id} broadcast error: {error}")
+
+    # ------------------ RECEIPTS ------------------
+    def _sent_payouts(self, session) -> List[Payout]:
+        return session.query(Payout).filter(Payout.status == "sent").order_by(Payout.nonce).all()
+
+    def _commit_receipts(self, session, confirmed: List[Payout]):
+        for payout in confirmed:
+            self._record_confirmed(session, payout)
+        session.commit()
+
+    async def track_sent(self) -> int:
+        session = Session(expire_on_commit=False)
+        try:
+            sent = await asyncio.to_thread(self._sent_payouts, session)
+            if not sent:
+                return 0
+            hashes = [[p.tx_hash] + (p.previous_hashes.split(",") if p.previous_hashes else []) for p in sent]
+            receipts = await asyncio.gather(*(self._first_receipt(h) for h in hashes))
+            now = datetime.datetime.utcnow()
+            done = 0
+            confirmed: List[Payout] = []
+            for payout, receipt in zip(sent, receipts):
+                if receipt is not None:
+                    mined_hash = receipt["transactionHash"].hex()
+                    payout.tx_hash = mined_hash if mined_hash.startswith("0x") else "0x" + mined_hash
+                    if receipt["status"] == 1:
+                        payout.status = "confirmed"
+                        confirmed.append(payout)
+                    else:
+                        # Nessun reinvio automatico (il revert si ripeterebbe): resta "failed" per una verifica a mano
+                        payout.status = "failed"
+                        payout.last_error = "Transaction reverted."
+                        logging.error(f"Payout {payout.id} reverted ({payout.kind} to {payout.wallet}): {payout.tx_hash}; "
+                                      f"marked failed, needs manual review")
+                    done += 1
+                elif payout.sent_at and (now - payout.sent_at).total_seconds() > self.replace_after:
+                    await self._replace(payout)
+            await asyncio.to_thread(self._commit_receipts, session, confirmed)
+            if self.on_confirmed:
+                for payout in confirmed:
+                    self.on_confirmed(payout)
+            return done
+        except Exception:
+            await asyncio.to_thread(session.rollback)
+            raise
+        finally:
+            session.close()
+
+    async def _first_receipt(self, hashes: List[str]):
+        for tx_hash in hashes:
+            receipt = await self.chain.get_receipt(tx_hash)
+            if receipt is not None:
+                return receipt
+        return None
+
+    async def _replace(self, payout: Payout):
+        """Re-sends the same nonce with a bumped gas price (replace-by-fee)."""
+        bumped = int(max(payout.gas_price or 0, await self.gas_price()) * self.fee_bump)
+        if self.max_gas_price:
+            bumped = min(bumped, self.max_gas_price)
+        if bumped <= (payout.gas_price or 0):
+            # Tetto raggiunto: ritrasmette lo stesso tx senza cambiarlo
+            bumped = payout.gas_price
+        tx = await self._build(payout, bumped)
+        new_hash, raw_tx = self.chain.sign(tx, self.private_key)
+        if new_hash != payout.tx_hash:
+            previous = payout.previous_hashes.split(",") if payout.previous_hashes else []
+            payout.previous_hashes = ",".join(previous + [payout.tx_hash])
+        payout.tx_hash = new_hash
+        payout.gas_price = bumped
+        payout.sent_at = datetime.datetime.utcnow()
+        payout.attempts = (payout.attempts or 0) + 1
+        try:
+            await self.chain.send_raw(raw_tx)
+            logging.info(f"Payout {payout.id} replaced (nonce {payout.nonce}, gasPrice {bumped})")
+        except Exception as e:
+            self._handle_send_error(payout, e)
+
+    def _record_confirmed(self, session, payout: Payout):
+        if payout.kind != "token" or not payout.amount:
+            return
+        counters.add(total_out=payout.amount, session=session)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – prize_engine.py
+-------------------------------------
+Weighted prize sampler for the wheel:
+ • Builds a Walker/Vose alias table once from the prize table
+ • O(1) single draws (draw) and bulk draws (draw_many) for simulation
+ • Rebuilds only when the configured table actually changes
+
+Run `python prize_engine.py 1000000` to Monte Carlo the payout odds
+(set PRIZE_TABLE_FILE to check a campaign table before it goes live).
+"""
+
+import os, sys, json, random, threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Tabella premi di default (peso relativo, non deve sommare a 100)
+DEFAULT_PRIZES: List[Tuple[str, float]] = [
+    ("10 GKY", 37.075),
+    ("20 GKY", 15),
+    ("50 GKY", 10),
+    ("100 GKY", 1.50),
+    ("NFTSTARTER", 0.025),
+    ("500 GKY", 0.25),
+    ("1000 GKY", 0.25),
+    ("NO PRIZE", 40.50),
+]
+
+def _build_alias(weights: Sequence[float]) -> Tuple[List[float], List[int]]:
+    """Vose's alias method: returns (prob, alias) for len(weights) columns."""
+    n = len(weights)
+    total = float(sum(weights))
+    scaled = [w * n / total for w in weights]
+    prob = [0.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = (scaled[l] + scaled[s]) - 1.0
+        (small if scaled[l] < 1.0 else large).append(l)
+    # Residui numerici: le colonne rimaste sono "piene"
+    for i in large + small:
+        prob[i] = 1.0
+    return prob, alias
+
+class PrizeEngine:
+    """Alias-table sampler over a (prize, weight) table."""
+
+    def __init__(self, prizes: Sequence[Tuple[str, float]] = DEFAULT_PRIZES, rng: Optional[random.Random] = None):
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._table: Tuple[Tuple[str, float], ...] = ()
+        self.configure(prizes)
+
+    @property
+    def table(self) -> Tuple[Tuple[str, float], ...]:
+        return self._table
+
+    def configure(self, prizes: Sequence[Tuple[str, float]]) -> bool:
+        """Installs a new prize table. Returns False (no rebuild) if it is unchanged."""
+        table = tuple((str(name), float(weight)) for name, weight in prizes)
+        if table == self._table:
+            return False
+        if not table:
+            raise ValueError("Prize table is empty.")
+        if any(weight < 0 for _, weight in table):
+            raise ValueError("Prize weights must be non-negative.")
+        if sum(weight for _, weight in table) <= 0:
+            raise ValueError("Prize weights must sum to a positive value.")
+        prob, alias = _build_alias([weight for _, weight in table])
+        names = [name for name, _ in table]
+        # Swap atomico: un draw concorrente vede sempre una tabella coerente
+        with self._lock:
+            self._state = (len(names), names, prob, alias)
+            self._table = table
+        return True
+
+    def draw(self) -> str:
+        n, names, prob, alias = self._state
+        u = self._rng.random() * n
+        i = int(u)
+        return names[i] if (u - i) < prob[i] else names[alias[i]]
+
+    def draw_many(self, count: int) -> List[str]:
+        n, names, prob, alias = self._state
+        rand = self._rng.random
+        out = []
+        append = out.append
+        for _ in range(count):
+            u = rand() * n
+            i = int(u)
+            append(names[i] if (u - i) < prob[i] else names[alias[i]])
+        return out
+
+    def simulate(self, spins: int) -> Dict[str, float]:
+        """Monte Carlo run: returns the observed frequency (%) of each prize."""
+        counts = dict.fromkeys((name for name, _ in self._table), 0)
+        for name in self.draw_many(spins):
+            counts[name] += 1
+        return {name: 100.0 * c / spins for name, c in counts.items()} if spins else counts
+
+    def expected(self) -> Dict[str, float]:
+        total = sum(weight for _, weight in self._table)
+        return {name: 100.0 * weight / total for name, weight in self._table}
+
+def load_prize_table(path: Optional[str] = None) -> List[Tuple[str, float]]:
+    """Reads a JSON table [["10 GKY", 37.075], ...] from PRIZE_TABLE_FILE, else the default."""
+    path = path or os.getenv("PRIZE_TABLE_FILE")
+    if not path:
+        return list(DEFAULT_PRIZES)
+    with open(path, encoding="utf-8") as f:
+        return [(name, weight) for name, weight in json.load(f)]
+
+# Istanza condivisa usata da main.get_prize()
+engine = PrizeEngine(load_prize_table())
+
+def main():
+    spins = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    observed = engine.simulate(spins)
+    expected = engine.expected()
+    print(f"{'Prize':<12} {'Expected %':>11} {'Observed %':>11}")
+    for name, _ in engine.table:
+        print(f"{name:<12} {expected[name]:>11.4f} {observed[name]:>11.4f}")
+
+if __name__ == "__main__":
+    main()
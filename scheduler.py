@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – scheduler.py
+----------------------------------
+Durable delayed credits:
+ • schedule() writes a scheduled_credits row in the caller's transaction
+ • One timer loop sleeps until the next due row (or a notify())
+ • Due credits are applied in batched UPDATEs and survive restarts
+"""
+
+import asyncio, datetime, logging
+from collections import defaultdict
+from typing import Callable, Optional
+
+from sqlalchemy import bindparam, func, update
+
+from database import Session, User, ScheduledCredit
+
+class CreditScheduler:
+    """Applies scheduled_credits rows when they fall due."""
+
+    def __init__(self, batch_size: int = 500, max_sleep: float = 60.0,
+                 on_applied: Optional[Callable[..., None]] = None):
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        # Chiamato con gli id utente accreditati, dopo il commit
+        self.on_applied = on_applied
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, session, user_id: int, extra_spins: int, delay: float, reason: Optional[str] = None) -> ScheduledCredit:
+        """Adds a credit due in `delay` seconds; it is durable once the caller commits."""
+        credit = ScheduledCredit(
+            user_id=user_id,
+            extra_spins=extra_spins,
+            reason=reason,
+            due_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+        )
+        session.add(credit)
+        return credit
+
+    def notify(self):
+        """Re-arms the timer after a schedule() that may be earlier than the current wait."""
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                # Query e UPDATE sono sincrone: fuori dall'event loop, come le altre letture pesanti
+                delay = await asyncio.to_thread(self._drain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Credit scheduler error: {e}")
+                delay = self.max_sleep
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _drain(self) -> float:
+        """Applies every due batch; returns the seconds until the next due row."""
+        while self.apply_due() == self.batch_size:
+            pass
+        return self._seconds_to_next_due()
+
+    def _seconds_to_next_due(self) -> float:
+        session = Session()
+        try:
+            next_due = (session.query(func.min(ScheduledCredit.due_at))
+                        .filter(ScheduledCredit.applied_at.is_(None)).scalar())
+        finally:
+            session.close()
+        if next_due is None:
+            return self.max_sleep
+        remaining = (next_due - datetime.datetime.utcnow()).total_seconds()
+        return min(max(remaining, 0.0), self.max_sleep)
+
+    def apply_due(self) -> int:
+        """Credits one batch of due rows in a single transaction; returns how many were applied."""
+        now = datetime.datetime.utcnow()
+        session = Session()
+        try:
+            due = (session.query(ScheduledCredit.id, ScheduledCredit.user_id, ScheduledCredit.extra_spins)
+                   .filter(ScheduledCredit.applied_at.is_(None), ScheduledCredit.due_at <= now)
+                   .order_by(ScheduledCredit.due_at).limit(self.batch_size).all())
+            if not due:
+                return 0
+            ids = [credit_id for credit_id, _, _ in due]
+            # Prenota le righe: se un altro processo le ha già applicate il rowcount non torna
+            claimed = session.execute(
+                update(ScheduledCredit.__table__)
+                .where(ScheduledCredit.__table__.c.id.in_(ids), ScheduledCredit.__table__.c.applied_at.is_(None))
+                .values(applied_at=now)
+            ).rowcount
+            if claimed != len(ids):
+                session.rollback()
+                return 0
+            per_user = defaultdict(int)
+            for _, user_id, extra_spins in due:
+                per_user[user_id] += extra_spins
+            users = User.__table__
+            session.execute(
+                update(users).where(users.c.id == bindparam("uid"))
+                .values(extra_spins=users.c.extra_spins + bindparam("amount")),
+                [{"uid": user_id, "amount": amount} for user_id, amount in per_user.items()],
+            )
+            session.commit()
+            logging.info(f"Scheduled credits applied: {len(ids)} for {len(per_user)} users")
+            if self.on_applied is not None:
+                self.on_applied(*per_user)
+            return len(ids)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – shared_state.py
+-------------------------------------
+State shared between uvicorn worker processes:
+ • Pluggable key/value backend: Redis when SHARED_STATE_URL is set,
+   an in-memory stand-in otherwise (single process / tests)
+ • Atomic token buckets on Redis for the cross-worker rate limiter
+   (the local stand-in is middleware.TokenBuckets)
+ • Database leases so singleton jobs (payout worker) run in one process only
+"""
+
+import os, time, socket, datetime, logging, uuid
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+
+from database import Session, Lease
+
+# ------------------ KEY/VALUE BACKENDS ------------------
+class MemoryBackend:
+    """In-process stand-in for the shared backend (same async API as RedisBackend)."""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._data: Dict[str, Tuple[Optional[float], str]] = {}
+
+    def _alive(self, key: str) -> bool:
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        expires, _ = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return False
+        return True
+
+    def _store(self, key: str, value: str, ttl: Optional[float]):
+        if len(self._data) >= self.maxsize and key not in self._data:
+            # Pieno: elimina la chiave più vecchia (ordine di inserimento)
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + ttl if ttl else None, value)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._data[key][1] if self._alive(key) else None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        self._store(key, value, ttl)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Sets key only if absent; True if it was set."""
+        if self._alive(key):
+            return False
+        self._store(key, value, ttl)
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        if self._alive(key):
+            expires, value = self._data[key]
+            self._data[key] = (expires, str(int(value) + amount))
+        else:
+            self._store(key, str(amount), ttl)
+        return int(self._data[key][1])
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def close(self):
+        pass
+
+# Token bucket atomico: refill dal tempo del server Redis (niente skew tra dyno), poi consumo
+TOKEN_BUCKET_LUA = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local allowed, wait = 0, 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+class RedisBackend:
+    """Redis-backed shared state (requires the optional `redis` package)."""
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("Error: SHARED_STATE_URL is set but the 'redis' package is not installed.")
+        self._redis = redis_asyncio.from_url(url, decode_responses=True)
+        self._token_bucket = self._redis.register_script(TOKEN_BUCKET_LUA)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self._redis.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return bool(await self._redis.set(key, value, px=int(ttl * 1000) if ttl else None, nx=True))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, amount)
+            if ttl:
+                # Il TTL parte dal primo incremento
+                pipe.pexpire(key, int(ttl * 1000), nx=True)
+            results = await pipe.execute()
+        return int(results[0])
+
+    async def delete(self, key: str):
+        await self._redis.delete(key)
+
+    async def take_tokens(self, key: str, rate: float, burst: float, cost: float = 1.0) -> Tuple[bool, float]:
+        """Same contract as middleware.TokenBuckets.take_tokens, atomic across workers."""
+        allowed, wait = await self._token_bucket(keys=[key], args=[rate, burst, cost])
+        return bool(int(allowed)), float(wait)
+
+    async def close(self):
+        await self._redis.aclose()
+
+def backend_from_env():
+    url = os.getenv("SHARED_STATE_URL")
+    if url:
+        logging.info("Shared state backend: redis")
+        return RedisBackend(url)
+    return MemoryBackend()
+
+shared = backend_from_env()
+
+# ------------------ LEASES ------------------
+class DatabaseLease:
+    """Time-limited lock row in `leases`; renew it well before `ttl` runs out."""
+
+    def __init__(self, name: str, ttl: float = 30.0):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.held = False
+
+    def acquire(self) -> bool:
+        """Acquires or renews the lease; returns whether this process holds it."""
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(seconds=self.ttl)
+        leases = Lease.__table__
+        session = Session()
+        try:
+            renewed = session.execute(
+                update(leases)
+                .where(leases.c.name == self.name, or_(leases.c.holder == self.holder, leases.c.expires_at < now))
+                .values(holder=self.holder, expires_at=expires)
+            ).rowcount
+            if not renewed:
+                try:
+                    with session.begin_nested():
+                        session.add(Lease(name=self.name, holder=self.holder, expires_at=expires))
+                except IntegrityError:
+                    session.rollback()
+                    self._set_held(False)
+                    return False
+            session.commit()
+            self._set_held(True)
+            return True
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Lease {self.name} error: {e}")
+            self._set_held(False)
+            return False
+        finally:
+            session.close()
+
+    def _set_held(self, held: bool):
+        if held != self.held:
+            logging.info(f"Lease {self.name} {'acquired' if held else 'not held'} by {self.holder}")
+        self.held = held
+
+    def release(self):
+        if not self.held:
+            return
+        session = Session()
+        try:
+            session.query(Lease).filter(Lease.name == self.name, Lease.holder == self.holder).delete(synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Lease {self.name} release error: {e}")
+        finally:
+            session.close()
+        self.held = False
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – spin_service.py
+-------------------------------------
+The whole spin in one transaction on one connection:
+ • Get-or-create the user (a concurrent first spin for the same wallet re-reads the row)
+ • Atomic spin decrement (date guard for the free spin, extra_spins > 0 otherwise)
+ • Prize draw and PremioVinto insert (plus optional payout enqueue)
+ • A single commit (the history row can be handed to a HistoryWriter instead)
+ • Batches of n spins: one reserving UPDATE, one draw_many, one bulk insert
+ • Prize rollups (analytics) move with the history rows, in the same commit
+"""
+
+import datetime, logging
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import insert, or_
+from sqlalchemy.exc import IntegrityError
+
+import analytics
+from database import Session, User, PremioVinto
+from history_writer import HistoryWriter
+
+class NoSpinsLeft(Exception):
+    """Raised when the wallet has neither the daily free spin nor extra spins."""
+
+def _create_user(session, wallet_address: str, last_free_spin_date: Optional[datetime.date]) -> Optional[int]:
+    """Inserts a new user in a savepoint; None if a concurrent request created the wallet first."""
+    user = User(wallet_address=wallet_address, extra_spins=0, last_free_spin_date=last_free_spin_date, last_claimed_tasks="")
+    try:
+        with session.begin_nested():
+            session.add(user)
+    except IntegrityError:
+        return None
+    logging.info(f"New user created: {wallet_address}")
+    return user.id
+
+def _consume_spin(session, user_id: int, today: datetime.date) -> Optional[bool]:
+    """Returns True if the free spin was used, False for an extra spin, None if no spin is left."""
+    used_free = (session.query(User)
+                 .filter(User.id == user_id,
+                         or_(User.last_free_spin_date.is_(None), User.last_free_spin_date < today))
+                 .update({User.last_free_spin_date: today}, synchronize_session=False))
+    if used_free:
+        return True
+    used_extra = (session.query(User)
+                  .filter(User.id == user_id, User.extra_spins > 0)
+                  .update({User.extra_spins: User.extra_spins - 1}, synchronize_session=False))
+    if used_extra:
+        return False
+    return None
+
+def perform_spin(wallet_address: str, today: datetime.date, draw: Callable[[], str],
+                 enqueue: Optional[Callable[[object, str, str], bool]] = None,
+                 history: Optional[HistoryWriter] = None) -> dict:
+    """
+    Runs one spin for an already checksummed wallet and commits once.
+    `enqueue(session, wallet, prize)` may add a payout to the same transaction;
+    with `history` the PremioVinto row is written behind, after the commit.
+    """
+    session = Session()
+    try:
+        find = session.query(User.id, User.telegram_id, User.extra_spins).filter(User.wallet_address == wallet_address)
+        row = find.first()
+        # Nuovo utente: usa subito il free spin di oggi
+        user_id = _create_user(session, wallet_address, today) if row is None else None
+        if user_id is not None:
+            telegram_id, extra_spins, free_spin = None, 0, True
+        else:
+            # Utente esistente, o creato nel frattempo da un primo spin concorrente: si rilegge la riga
+            row = row or find.one()
+            user_id, telegram_id, extra_spins = row
+            free_spin = _consume_spin(session, user_id, today)
+            if free_spin is None:
+                raise NoSpinsLeft()
+            if not free_spin:
+                extra_spins -= 1
+        premio = draw()
+        if history is None:
+            history_row = {"telegram_id": telegram_id or "N/A", "wallet": wallet_address, "premio": premio,
+                           "user_id": user_id, "timestamp": datetime.datetime.utcnow()}
+            session.add(PremioVinto(**history_row))
+            analytics.record(session, [history_row])
+        queued = bool(enqueue and enqueue(session, wallet_address, premio))
+        session.commit()
+        if history is not None:
+            history.record(telegram_id, wallet_address, premio, user_id)
+        # Il free spin di oggi è comunque consumato: restano solo gli extra
+        return {
+            "prize": premio,
+            "free_spin": free_spin,
+            "queued": queued,
+            "user_id": user_id,
+            "available_spins": max(extra_spins or 0, 0),
+        }
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _reserve_spins(session, user_id: int, count: int, today: datetime.date) -> Optional[Tuple[bool, int]]:
+    """
+    Takes `count` spins (the free one first) in a single guarded UPDATE.
+    Returns (free spin used, extra spins left), or None if not enough spins are left.
+    """
+    for _ in range(2):
+        row = session.query(User.extra_spins, User.last_free_spin_date).filter(User.id == user_id).one()
+        extra_spins, last_free = row[0] or 0, row[1]
+        free = last_free is None or last_free < today
+        needed_extra = count - (1 if free else 0)
+        if needed_extra > extra_spins:
+            return None
+        # Stesso stato del free spin letto sopra: se cambia nel frattempo si rilegge
+        free_guard = (or_(User.last_free_spin_date.is_(None), User.last_free_spin_date < today) if free
+                      else User.last_free_spin_date >= today)
+        reserved = (session.query(User)
+                    .filter(User.id == user_id, User.extra_spins >= needed_extra, free_guard)
+                    .update({User.extra_spins: User.extra_spins - needed_extra, User.last_free_spin_date: today},
+                            synchronize_session=False))
+        if reserved:
+            return free, extra_spins - needed_extra
+    return None
+
+def perform_spin_batch(wallet_address: str, today: datetime.date, count: int, draw_many: Callable[[int], List[str]],
+                       enqueue: Optional[Callable[[object, str, str], bool]] = None,
+                       history: Optional[HistoryWriter] = None) -> dict:
+    """
+    Runs `count` spins for an already checksummed wallet in one transaction.
+    Raises NoSpinsLeft (and spins nothing) if fewer than `count` spins are available.
+    """
+    session = Session()
+    try:
+        find = session.query(User.id, User.telegram_id).filter(User.wallet_address == wallet_address)
+        row = find.first()
+        if row is None:
+            user_id = _create_user(session, wallet_address, None)
+            row = (user_id, None) if user_id is not None else find.one()
+        user_id, telegram_id = row
+        reservation = _reserve_spins(session, user_id, count, today)
+        if reservation is None:
+            raise NoSpinsLeft()
+        free_spin, remaining = reservation
+        prizes = draw_many(count)
+        rows = [{"telegram_id": telegram_id or "N/A", "wallet": wallet_address, "premio": premio,
+                 "user_id": user_id, "timestamp": datetime.datetime.utcnow()} for premio in prizes]
+        if history is None:
+            session.execute(insert(PremioVinto), rows)
+            analytics.record(session, rows)
+        queued = [bool(enqueue and enqueue(session, wallet_address, premio)) for premio in prizes]
+        session.commit()
+        if history is not None:
+            for premio in prizes:
+                history.record(telegram_id, wallet_address, premio, user_id)
+        return {
+            "prizes": prizes,
+            "free_spin": free_spin,
+            "queued": queued,
+            "user_id": user_id,
+            "available_spins": max(remaining, 0),
+        }
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -1,40 +1,333 @@
-import subprocess
-import time
-import os
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – start_app.py
+----------------------------------
+Development server with hot reload:
+ • Watches the project but skips node_modules, build output, databases and
+   the struttura*.txt dumps (DEV_IGNORE adds more globs)
+ • Bursts of events (editor saves, git checkout) are coalesced into one
+   action after DEV_DEBOUNCE_MS of quiet
+ • static/ and dist/ changes rebuild the asset manifest inside the running
+   server: no restart
+ • .py changes fork a fresh server from a warm zygote that has already imported
+   web3, eth_account, jose, fastapi, ...; the zygote is forked before the
+   watcher and tunnel threads exist, so it stays single-threaded and safe to
+   fork from; the listening socket and the ngrok tunnel survive every reload
+"""
+
+import os, sys, time, queue, signal, socket, fnmatch, logging, importlib, threading
+from typing import List, Optional, Set
+
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-class AppRestartHandler(FileSystemEventHandler):
-    def __init__(self):
-        self.process = None
-        self.start_app()
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = os.getenv("DEV_HOST", "127.0.0.1")
+PORT = int(os.getenv("DEV_PORT", "5000"))
+DEBOUNCE = float(os.getenv("DEV_DEBOUNCE_MS", "150")) / 1000
+IGNORE = ["node_modules", ".git", "__pycache__", ".assets", "struttura*.txt", "*.db", "*.db-*",
+          "*.pyc", "*.tmp", "*.log", "*.whl", "*.swp", "*~"]
+IGNORE += [glob.strip() for glob in os.getenv("DEV_IGNORE", "").split(",") if glob.strip()]
+# Directory servite da assets.AssetStore: basta ricompilare il manifest
+ASSET_DIRS = ("static", "dist")
+WRITE_EVENTS = {"created", "modified", "moved", "deleted"}
+# Librerie pesanti importate una volta sola nel processo padre; i moduli del progetto no,
+# così ogni figlio li ricarica freschi
+WARM_MODULES = ["web3", "eth_account", "jose", "fastapi", "pydantic", "sqlalchemy", "aiohttp",
+                "pytz", "dotenv", "uvicorn", "pyngrok.ngrok"]
 
-    def start_app(self):
-        if self.process:
-            self.process.terminate()
-            self.process.wait()
-        print("\nStarting application...")
-        self.process = subprocess.Popen(['python', 'main.py'])
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+log = logging.getLogger("start_app")
 
-    def on_modified(self, event):
-        if event.src_path.endswith('.py') or event.src_path.endswith('.html'):
-            print(f"\nFile changed: {event.src_path}")
-            self.start_app()
+def ignored(rel: str) -> bool:
+    # Un glob vale sia per il percorso relativo sia per ogni suo componente
+    candidates = [rel] + rel.split("/")
+    return any(fnmatch.fnmatch(part, glob) for part in candidates for glob in IGNORE)
 
-def main():
-    handler = AppRestartHandler()
+def classify(rel: str) -> Optional[str]:
+    """"reload" for Python/config changes, "assets" for servable files, None otherwise."""
+    if rel.endswith(".py") or os.path.basename(rel) == ".env":
+        return "reload"
+    if rel.split("/", 1)[0] in ASSET_DIRS:
+        return "assets"
+    return None
+
+# ------------------ WATCHER ------------------
+class DebouncedHandler(FileSystemEventHandler):
+    """Collects changed paths and emits one action per burst on `actions`."""
+
+    def __init__(self, actions: "queue.Queue"):
+        self.actions = actions
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def on_any_event(self, event):
+        # inotify segnala anche open/close: l'import dei moduli nel figlio non deve innescare reload
+        if event.is_directory or event.event_type not in WRITE_EVENTS:
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if not path:
+                continue
+            rel = os.path.relpath(path, BASE_DIR).replace(os.sep, "/")
+            if rel.startswith("..") or ignored(rel) or classify(rel) is None:
+                continue
+            with self._lock:
+                self._pending.add(rel)
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(DEBOUNCE, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            changed, self._pending = self._pending, set()
+            self._timer = None
+        if changed:
+            kinds = {classify(rel) for rel in changed}
+            self.actions.put(("reload" if "reload" in kinds else "assets", sorted(changed)))
+
+def watch(handler: FileSystemEventHandler) -> Observer:
+    # Niente watch ricorsivo su "." : node_modules da solo sono migliaia di directory
     observer = Observer()
-    observer.schedule(handler, path='.', recursive=True)
+    observer.schedule(handler, BASE_DIR, recursive=False)
+    for name in sorted(os.listdir(BASE_DIR)):
+        if os.path.isdir(os.path.join(BASE_DIR, name)) and not ignored(name):
+            observer.schedule(handler, os.path.join(BASE_DIR, name), recursive=True)
     observer.start()
+    return observer
+
+# ------------------ SERVER PROCESS ------------------
+def _listen_for_rebuilds(fd: int, store):
+    with os.fdopen(fd, "rb", buffering=0) as pipe:
+        for line in pipe:
+            if line.strip() == b"assets":
+                started = time.perf_counter()
+                store.build()
+                log.info(f"Assets rebuilt in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+def _serve(sock: socket.socket, fd: int):
+    """Body of the forked child: import the app and serve on the inherited socket."""
+    import uvicorn
+    sys.path.insert(0, BASE_DIR)
+    os.chdir(BASE_DIR)
+    import main
+    threading.Thread(target=_listen_for_rebuilds, args=(fd, main.static_assets), daemon=True).start()
+    uvicorn.Server(uvicorn.Config(main.app, log_level="info")).run(sockets=[sock])
+
+def _fork_server(sock: socket.socket, zygote_fds: tuple):
+    """(pid, control fd) of a new server process; only ever called from the single-threaded zygote."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(write_fd)
+        for fd in zygote_fds:
+            os.close(fd)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            _serve(sock, read_fd)
+        except Exception:
+            # Errore all'import dell'app: si riparte al prossimo salvataggio di un .py
+            logging.exception("Dev server crashed")
+            code = 1
+        finally:
+            # Nessun atexit/finally della zygote nel figlio
+            os._exit(code)
+    os.close(read_fd)
+    return pid, write_fd
+
+def _stop_server(pid: int, control: int):
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+    os.close(control)
+
+def _zygote(sock: socket.socket, commands_fd: int, acks_fd: int):
+    """
+    Command loop of the zygote: one line per command from the parent
+    (spawn, assets, env KEY=VALUE, quit), acknowledged with "ok".
+    """
+    # Ctrl+C arriva a tutto il gruppo: lo spegnimento lo decide il padre (quit o EOF)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pid = control = None
+    with os.fdopen(commands_fd, "rb", buffering=0) as commands:
+        for line in commands:
+            command, _, arg = line.decode().strip().partition(" ")
+            if command in ("spawn", "quit") and pid is not None:
+                _stop_server(pid, control)
+                pid = control = None
+            if command == "spawn":
+                pid, control = _fork_server(sock, (commands_fd, acks_fd))
+            elif command == "assets" and pid is not None:
+                try:
+                    os.write(control, b"assets\n")
+                except OSError:
+                    # Figlio morto (errore all'import): al prossimo .py riparte
+                    pass
+            elif command == "env":
+                key, _, value = arg.partition("=")
+                os.environ[key] = value
+            os.write(acks_fd, b"ok\n")
+            if command == "quit":
+                break
+    # EOF senza quit (padre ucciso): il server non resta orfano
+    if pid is not None:
+        _stop_server(pid, control)
+
+class DevServer:
+    def __init__(self, host: str = HOST, port: int = PORT):
+        self.host = host
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+        self.zygote: Optional[int] = None
+        self.commands: Optional[int] = None
+        self.acks = None
+        self.tunnel = None
+
+    def warm_up(self):
+        started = time.perf_counter()
+        for name in WARM_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+        log.info(f"Dependencies preloaded in {(time.perf_counter() - started) * 1000:.0f} ms")
 
+    def bind(self):
+        # Il socket resta aperto tra i reload: le connessioni aspettano nel backlog
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+
+    def start_zygote(self):
+        """Forks the zygote; must run before any thread (watcher, ngrok) is started."""
+        if threading.active_count() > 1:
+            log.warning(f"{threading.active_count()} threads alive before forking the zygote")
+        commands_read, commands_write = os.pipe()
+        acks_read, acks_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(commands_write)
+            os.close(acks_read)
+            code = 0
+            try:
+                _zygote(self.sock, commands_read, acks_write)
+            except Exception:
+                logging.exception("Dev server zygote crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(commands_read)
+        os.close(acks_write)
+        self.zygote, self.commands = pid, commands_write
+        self.acks = os.fdopen(acks_read, "rb", buffering=0)
+
+    def _send(self, command: str):
+        if self.zygote is None:
+            return
+        try:
+            os.write(self.commands, command.encode() + b"\n")
+            self.acks.readline()
+        except OSError:
+            log.error("Dev server zygote is gone: restart start_app.py")
+
+    def open_tunnel(self):
+        token = os.getenv("NGROK_AUTH_TOKEN")
+        if not token:
+            return
+        from pyngrok import ngrok
+        ngrok.set_auth_token(token)
+        self.tunnel = ngrok.connect(self.port)
+        # Il lifespan dell'app non apre un secondo tunnel (l'ambiente dei server è quello della zygote)
+        os.environ["NGROK_PUBLIC_URL"] = self.tunnel.public_url
+        self._send(f"env NGROK_PUBLIC_URL={self.tunnel.public_url}")
+        log.info(f"Ngrok tunnel URL: {self.tunnel.public_url}")
+
+    def spawn(self):
+        self._send("spawn")
+
+    def reload(self):
+        started = time.perf_counter()
+        self._send("spawn")
+        log.info(f"Server restarted in {(time.perf_counter() - started) * 1000:.0f} ms (+ app import)")
+
+    def rebuild_assets(self):
+        self._send("assets")
+
+    def close(self):
+        if self.zygote is not None:
+            self._send("quit")
+            os.close(self.commands)
+            self.acks.close()
+            try:
+                os.waitpid(self.zygote, 0)
+            except ChildProcessError:
+                pass
+            self.zygote = None
+        if self.tunnel is not None:
+            from pyngrok import ngrok
+            ngrok.kill()
+        if self.sock is not None:
+            self.sock.close()
+
+def run_forking():
+    server = DevServer()
+    server.warm_up()
+    server.bind()
+    # Prima di ngrok e del watcher: dopo ci sono thread e fork() non è più sicuro
+    server.start_zygote()
+    server.open_tunnel()
+    server.spawn()
+    actions: "queue.Queue" = queue.Queue()
+    observer = watch(DebouncedHandler(actions))
+    log.info(f"Dev server on http://{server.host}:{server.port} (watching, ignore: {', '.join(IGNORE)})")
     try:
         while True:
-            time.sleep(1)
+            action, changed = actions.get()
+            log.info(f"{action}: {', '.join(changed[:5])}{' ...' if len(changed) > 5 else ''}")
+            if action == "reload":
+                server.reload()
+            else:
+                server.rebuild_assets()
     except KeyboardInterrupt:
+        pass
+    finally:
         observer.stop()
-        if handler.process:
-            handler.process.terminate()
+        server.close()
     observer.join()
 
+def run_subprocess():
+    """Fallback without os.fork (Windows): debounced full restarts of uvicorn."""
+    import subprocess
+    command: List[str] = [sys.executable, "-m", "uvicorn", "main:app", "--host", HOST, "--port", str(PORT)]
+    process = subprocess.Popen(command, cwd=BASE_DIR)
+    actions: "queue.Queue" = queue.Queue()
+    observer = watch(DebouncedHandler(actions))
+    try:
+        while True:
+            action, changed = actions.get()
+            log.info(f"restart ({action}): {', '.join(changed[:5])}")
+            process.terminate()
+            process.wait()
+            process = subprocess.Popen(command, cwd=BASE_DIR)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        process.terminate()
+    observer.join()
+
+def main():
+    if hasattr(os, "fork"):
+        run_forking()
+    else:
+        run_subprocess()
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Gianky Coin Web App – startup_profile.py
+----------------------------------------
+Cold-start profile of the web app, each run in a fresh interpreter:
+ • Import-time breakdown of `import main` (python -X importtime), per package
+ • Import-to-ready time: `import main` plus the lifespan startup (schema check,
+   asset manifest, workers) until uvicorn would accept connections
+ • --budget-ms turns it into a startup regression check: exit status 1 when the
+   median import-to-ready time is over budget (CI, or before a deploy)
+
+Examples:
+    python startup_profile.py
+    python startup_profile.py --runs 5 --budget-ms 1500 --json startup.json
+"""
+
+import os, re, sys, json, argparse, statistics, subprocess, tempfile
+from collections import Counter
+from typing import Dict, List, Tuple
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+READY_SNIPPET = """
+import time, json, asyncio
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+async def ready():
+    async with main.app.router.lifespan_context(main.app):
+        return time.perf_counter()
+ready_at = asyncio.run(ready())
+print(json.dumps({"import_ms": (imported - started) * 1000, "ready_ms": (ready_at - started) * 1000}))
+"""
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+def _child_env(database_url: str) -> Dict[str, str]:
+    # Come benchmark.py: DB isolato, nessun job di sfondo, nessun tunnel né bot
+    env = dict(os.environ)
+    env["DATABASE_URL"] = database_url
+    env.setdefault("DISTRIBUTION_PRIVATE_KEY", "0x" + "11" * 32)
+    env.setdefault("TOKEN_ADDRESS", "0x370806781689E670f85311700445449aC7C3Ff7a")
+    env["RUN_PAYOUT_WORKER"] = "0"
+    env["RUN_CREDIT_SCHEDULER"] = "0"
+    env.pop("NGROK_AUTH_TOKEN", None)
+    env.pop("BOT_WEBHOOK_URL", None)
+    return env
+
+def _run(args: List[str], env: Dict[str, str]) -> subprocess.CompletedProcess:
+    result = subprocess.run([sys.executable] + args, cwd=BASE_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr[-4000:])
+        raise SystemExit(f"Startup failed (exit {result.returncode})")
+    return result
+
+# ------------------ IMPORT BREAKDOWN ------------------
+def import_breakdown(env: Dict[str, str]) -> Tuple[float, List[Tuple[str, float]]]:
+    """(total ms, [(package, self ms)]) for `import main`, heaviest packages first."""
+    result = _run(["-X", "importtime", "-c", "import main"], env)
+    per_package: Counter = Counter()
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), len(match[3]), match[4]
+        per_package[name.split(".")[0]] += self_us
+        if indent == 0:
+            total_us += cumulative_us
+    return total_us / 1000, [(name, us / 1000) for name, us in per_package.most_common()]
+
+# ------------------ IMPORT TO READY ------------------
+def measure_ready(env: Dict[str, str]) -> Dict[str, float]:
+    result = _run(["-c", READY_SNIPPET], env)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time breakdown and import-to-ready time of main.py")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts to measure (median is reported)")
+    parser.add_argument("--top", type=int, default=20, help="packages to list in the breakdown")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "0")),
+                        help="fail (exit 1) when median import-to-ready exceeds this (0 = no check)")
+    parser.add_argument("--database-url", help="database to start against (default: throwaway SQLite)")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='gianky-startup-'), 'startup.db')}"
+    env = _child_env(database_url)
+    # Primo avvio scartato: crea lo schema e compila gli asset, come il primo boot di un dyno nuovo
+    first = measure_ready(env)
+    runs = [measure_ready(env) for _ in range(max(1, args.runs))]
+    import_total, packages = import_breakdown(env)
+
+    print(f"import main (-X importtime): {import_total:.0f} ms")
+    for name, ms in packages[:args.top]:
+        print(f"  {name:<24} {ms:8.1f} ms")
+    import_ms = statistics.median(run["import_ms"] for run in runs)
+    ready_ms = statistics.median(run["ready_ms"] for run in runs)
+    print(f"first start (schema + asset build): {first['ready_ms']:.0f} ms")
+    print(f"import: {import_ms:.0f} ms   import-to-ready: {ready_ms:.0f} ms   (median of {len(runs)})")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"import_ms": import_ms, "ready_ms": ready_ms, "first_ready_ms": first["ready_ms"],
+                       "runs": runs, "packages": dict(packages), "budget_ms": args.budget_ms or None}, f, indent=2)
+    if args.budget_ms and ready_ms > args.budget_ms:
+        print(f"FAIL: import-to-ready {ready_ms:.0f} ms exceeds the {args.budget_ms:.0f} ms budget")
+        sys.exit(1)
+    if args.budget_ms:
+        print(f"OK: within the {args.budget_ms:.0f} ms budget")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Bulk spin allowances (one query) and the daily reminder built on top of them.
+"""
+
+import os, sys, datetime, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='gianky-test-'), 'test.db')}")
+
+import pytest
+
+from allowance import TIMEZONE, allowances
+from database import Session, User, init_db
+
+init_db()
+
+DAY = datetime.date(2026, 1, 15)
+FRESH = "0x" + "a1" * 20      # free spin libero, 2 extra
+USED = "0x" + "b2" * 20       # free spin già usato oggi, 3 extra
+EMPTY = "0x" + "c3" * 20      # free spin usato, nessun extra
+
+@pytest.fixture(scope="module", autouse=True)
+def users():
+    session = Session()
+    try:
+        session.query(User).filter(User.wallet_address.in_([FRESH, USED, EMPTY])).delete(synchronize_session=False)
+        session.add_all([
+            User(wallet_address=FRESH, telegram_id="101", extra_spins=2, last_free_spin_date=DAY - datetime.timedelta(days=1)),
+            User(wallet_address=USED, telegram_id="N/A", extra_spins=3, last_free_spin_date=DAY),
+            User(wallet_address=EMPTY, telegram_id="103", extra_spins=0, last_free_spin_date=DAY),
+        ])
+        session.commit()
+    finally:
+        session.close()
+
+def _ours(rows):
+    return [row for row in rows if row[0] in (FRESH, USED, EMPTY)]
+
+def test_allowances_filters():
+    assert _ours(allowances(day=DAY)) == [(FRESH, "101", 3), (USED, "N/A", 3)]
+    assert _ours(allowances(day=DAY, min_available=0)) == [(FRESH, "101", 3), (USED, "N/A", 3), (EMPTY, "103", 0)]
+    assert _ours(allowances(day=DAY, free_spin_only=True)) == [(FRESH, "101", 3)]
+    assert allowances(wallets=[USED], day=DAY) == [(USED, "N/A", 3)]
+
+def test_reminder_recipients_skip_used_free_spins_and_missing_chats(monkeypatch):
+    bot = pytest.importorskip("bot")
+    monkeypatch.setattr("allowance.today", lambda: DAY)
+    # Stessa query di allowances(free_spin_only=True): solo chi ha ancora il free spin e una chat Telegram
+    assert ("101", 3) in bot.reminder_recipients()
+    assert all(chat not in ("N/A", "103") for chat, _ in bot.reminder_recipients())
+
+def test_seconds_until_next_rome_time():
+    bot = pytest.importorskip("bot")
+    now = TIMEZONE.localize(datetime.datetime(2026, 3, 10, 9, 30))
+    assert bot.seconds_until("10:00", now) == 30 * 60
+    assert bot.seconds_until("09:00", now) == 23.5 * 3600
@@ -0,0 +1,52 @@
+"""
+Buffered prize history: backpressure refuses new spins when the buffer is full,
+and rows of admitted spins survive failed flushes.
+"""
+
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='gianky-test-'), 'test.db')}")
+
+import history_writer
+from database import Session, PremioVinto, init_db
+from history_writer import HistoryWriter
+
+init_db()
+
+def _history_rows() -> int:
+    session = Session()
+    try:
+        return session.query(PremioVinto).filter(PremioVinto.premio == "TEST").count()
+    finally:
+        session.close()
+
+def _record(writer: HistoryWriter, n: int):
+    for _ in range(n):
+        writer.record(None, "0x" + "4" * 40, "TEST", 1)
+
+def test_full_buffer_refuses_new_spins():
+    writer = HistoryWriter(batch_size=100, max_buffer=3, admit_ms=50)
+    assert writer.admit(3)
+    _record(writer, 3)
+    # Nessun thread di flush avviato: lo spazio non si libera e lo spin viene rifiutato
+    assert not writer.has_room(1)
+    assert not writer.admit(1)
+    assert writer.stats()["rejected"] == 1
+
+def test_failed_flush_keeps_every_row(monkeypatch):
+    before = _history_rows()
+    writer = HistoryWriter(batch_size=100, max_buffer=3, admit_ms=50)
+    # Più righe del limite (spin ammessi in concorrenza): nessuna va persa
+    _record(writer, 5)
+
+    def broken_record(session, rows):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(history_writer.analytics, "record", broken_record)
+    assert writer.flush() == 0
+    assert writer.pending() == 5
+    monkeypatch.undo()
+    assert writer.flush() == 5
+    assert writer.pending() == 0
+    assert _history_rows() == before + 5
@@ -0,0 +1,59 @@
+"""
+Savepoint inserts (ledger.consume, counter stripes) must stay inside the caller's
+transaction: a rollback after them leaves no row behind.
+"""
+
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='gianky-test-'), 'test.db')}")
+
+import pytest
+
+from database import Session, ConsumedTransaction, GlobalCounter, init_db
+from ledger import TxLedger, TxAlreadyUsed
+from counters import GlobalCounters
+
+init_db()
+
+def _count(model) -> int:
+    session = Session()
+    try:
+        return session.query(model).count()
+    finally:
+        session.close()
+
+def test_rollback_after_consume_leaves_no_ledger_row():
+    ledger = TxLedger()
+    session = Session()
+    try:
+        ledger.consume(session, "0x" + "ab" * 32, purpose="test")
+        session.rollback()
+    finally:
+        session.close()
+    assert _count(ConsumedTransaction) == 0
+    assert not ledger.is_consumed("0x" + "ab" * 32)
+
+def test_commit_after_consume_rejects_replay():
+    ledger = TxLedger()
+    tx_hash = "0x" + "cd" * 32
+    session = Session()
+    try:
+        ledger.consume(session, tx_hash, purpose="test")
+        session.commit()
+        with pytest.raises(TxAlreadyUsed):
+            ledger.consume(session, tx_hash.upper().replace("0X", "0x"), purpose="test")
+        session.rollback()
+    finally:
+        session.close()
+    assert ledger.is_consumed(tx_hash)
+
+def test_rollback_after_new_counter_stripe_leaves_no_row():
+    before = _count(GlobalCounter)
+    session = Session()
+    try:
+        GlobalCounters(stripes=1)._apply(session, 10.0, 0.0)
+        session.rollback()
+    finally:
+        session.close()
+    assert _count(GlobalCounter) == before
@@ -0,0 +1,54 @@
+"""
+Concurrent first spins for the same new wallet: the loser of the insert race
+re-reads the row instead of failing with a unique-constraint error.
+"""
+
+import os, sys, datetime, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='gianky-test-'), 'test.db')}")
+
+from sqlalchemy.orm import Query
+
+from database import Session, User, init_db
+from spin_service import perform_spin, perform_spin_batch
+
+init_db()
+
+def _add_user(wallet: str, extra_spins: int):
+    session = Session()
+    try:
+        session.add(User(wallet_address=wallet, extra_spins=extra_spins, last_claimed_tasks=""))
+        session.commit()
+    finally:
+        session.close()
+
+def _miss_first_lookup(monkeypatch):
+    # La prima lettura non vede l'utente: come se un altro spin lo avesse creato subito dopo
+    original, calls = Query.first, []
+
+    def first(query):
+        calls.append(query)
+        return None if len(calls) == 1 else original(query)
+
+    monkeypatch.setattr(Query, "first", first)
+
+def test_spin_after_losing_the_user_insert_race(monkeypatch):
+    wallet = "0x" + "6" * 40
+    _add_user(wallet, extra_spins=2)
+    _miss_first_lookup(monkeypatch)
+    result = perform_spin(wallet, datetime.date.today(), lambda: "NO PRIZE")
+    assert result["prize"] == "NO PRIZE"
+    session = Session()
+    try:
+        assert session.query(User).filter(User.wallet_address == wallet).count() == 1
+    finally:
+        session.close()
+
+def test_spin_batch_after_losing_the_user_insert_race(monkeypatch):
+    wallet = "0x" + "7" * 40
+    _add_user(wallet, extra_spins=2)
+    _miss_first_lookup(monkeypatch)
+    result = perform_spin_batch(wallet, datetime.date.today(), 3, lambda n: ["NO PRIZE"] * n)
+    assert result["prizes"] == ["NO PRIZE"] * 3
+    assert result["available_spins"] == 0
@@ -0,0 +1,30 @@
+"""
+Startup regression checks:
+ • `import main` must not load the lazily imported heavy stacks (web3, eth_account,
+   jose, pyngrok): deterministic, independent of machine speed
+ • startup_profile.py exits 1 when the median import-to-ready time is over
+   STARTUP_BUDGET_MS (default 1500 ms: ~1.2 s measured after lazy loading, ~2.6 s before)
+"""
+
+import os, sys, json, subprocess
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = os.getenv("STARTUP_BUDGET_MS", "1500")
+LAZY_MODULES = ["web3", "eth_account", "jose", "pyngrok"]
+
+sys.path.insert(0, BASE_DIR)
+from startup_profile import _child_env
+
+def test_import_main_leaves_heavy_modules_unloaded(tmp_path):
+    snippet = f"import sys, json, main; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    env = _child_env(f"sqlite:///{tmp_path / 'startup.db'}")
+    result = subprocess.run([sys.executable, "-c", snippet], cwd=BASE_DIR, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-2000:]
+    assert json.loads(result.stdout.strip().splitlines()[-1]) == []
+
+def test_startup_within_budget():
+    result = subprocess.run(
+        [sys.executable, os.path.join(BASE_DIR, "startup_profile.py"), "--runs", "3", "--top", "0", "--budget-ms", BUDGET_MS],
+        capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr[-2000:]